@@ -0,0 +1,67 @@
+"""
+Micro-benchmark for dispatching ready files to their modules
+
+Registers an increasing number of modules, each owning one idle pipe, plus a
+single module whose pipe is always readable, and measures the cost of one
+loop iteration (select + dispatch). The cost should stay flat regardless of
+the number of registered modules.
+
+Usage: python benchmarks/dispatch.py [iterations]
+"""
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from evdaemon import Daemon, Module
+
+SIZES = [1, 10, 100, 1000]
+
+class PipeModule(Module):
+    def __init__(self, name):
+        self.name = name
+        super().__init__()
+        self.rfd, self.wfd = os.pipe()
+        self.register_file(self.rfd, "ready")
+
+    def close(self):
+        self.unregister_file(self.rfd)
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+def measure(modules, iterations):
+    daemon = Daemon()
+    idle = [PipeModule("idle{}".format(i)) for i in range(modules - 1)]
+    for module in idle:
+        daemon.register(module)
+
+    hot = PipeModule("hot")
+    calls = [0]
+    def ready():
+        calls[0] += 1
+    hot.listen_private("ready", ready)
+    daemon.register(hot)
+    os.write(hot.wfd, b"x")
+
+    start = perf_counter()
+    for _ in range(iterations):
+        for key, events in daemon._selector.select(0):
+            daemon._trigger_file(key, events)
+    elapsed = perf_counter() - start
+
+    assert calls[0] == iterations
+    for module in idle + [hot]:
+        module.close()
+    daemon.close()
+    return elapsed / iterations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("{:>8} {:>14}".format("modules", "ns/dispatch"))
+    for size in SIZES:
+        per_call = measure(size, iterations)
+        print("{:>8} {:>14.0f}".format(size, per_call * 1e9))
+
+if __name__ == "__main__":
+    main()
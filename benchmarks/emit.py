@@ -0,0 +1,57 @@
+"""
+Micro-benchmark for emitting events through Hooks
+
+Emits an i3ipc-style event path with a payload to a module listening on
+several levels of the path and reports the cost per emit, alone and with a
+number of unrelated modules registered on the daemon.
+
+Usage: python benchmarks/emit.py [iterations]
+"""
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from evdaemon import Daemon, Module
+
+class ListenModule(Module):
+    def __init__(self, name):
+        self.name = name
+        super().__init__()
+
+def measure(others, iterations):
+    daemon = Daemon()
+    module = ListenModule("listen")
+    daemon.register(module)
+    for i in range(others):
+        other = ListenModule("other{}".format(i))
+        other.listen("wm", "title", lambda: None)
+        daemon.register(other)
+
+    calls = [0]
+    def listener(*args):
+        calls[0] += 1
+    module.listen("i3ipc", "event", "window", listener)
+    module.listen("i3ipc", "event", listener)
+    module.listen("i3ipc", "reply", "tree", listener)
+
+    payload = {"change": "title", "container": {"name": "title"}}
+    start = perf_counter()
+    for _ in range(iterations):
+        module.emit("i3ipc", "event", "window", payload)
+    elapsed = perf_counter() - start
+
+    assert calls[0] == 2 * iterations
+    daemon.close()
+    return elapsed / iterations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print("{:>8} {:>10}".format("modules", "ns/emit"))
+    for others in [0, 50]:
+        per_emit = measure(others, iterations)
+        print("{:>8} {:>10.0f}".format(others + 1, per_emit * 1e9))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+End-to-end benchmark for the i3 modules against a fake i3 server
+
+A fake i3 server listens on a unix socket in a temporary directory, serves
+every connection in its own thread and answers workspaces, outputs and tree
+queries. After the subscription, it replays a storm of synthetic events on
+the subscribed connection. Every event carries a sequence number, and the
+time from writing an event to the socket until the matching "wm" event is
+emitted is recorded. Every 100 events, a command is sent and its round trip
+time is recorded.
+
+Reports events per second, the number of "wm" events emitted and queries
+answered, p50/p99 latency, the p50 command round trip time under event load
+and the net number of allocated memory blocks per event. The benchmark's own
+bookkeeping accounts for about 2 blocks per event, anything above that is
+kept alive by the modules.
+
+Usage: python benchmarks/i3.py [events]
+"""
+import json
+import os
+import sys
+import threading
+from socket import socket, AF_UNIX, SHUT_RDWR
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from evdaemon import Daemon, Module
+from evdmodule_i3 import i3Module, i3ipcModule
+from evdmodule_i3.ipc import HEADER, MAGIC, MSG, EVENT
+
+RECT = {"x": 0, "y": 0, "width": 1920, "height": 1080}
+
+def workspace(con_id, num, output, focused = False, visible = False):
+    return {
+        "id": con_id, "num": num, "name": str(num), "rect": RECT,
+        "focused": focused, "visible": visible, "urgent": False,
+        "output": output, "nodes": [], "floating_nodes": []
+    }
+
+def window(con_id, name, focused = False):
+    return {
+        "id": con_id, "type": "con", "name": name, "window": con_id,
+        "rect": RECT, "focused": focused, "urgent": False,
+        "nodes": [], "floating_nodes": []
+    }
+
+class FakeI3(object):
+    """
+    A stand-in i3 server listening on a unix socket
+    """
+    def __init__(self, path, storm, events):
+        self.storm = storm
+        self.events = events
+        self.sent = [0.0] * events
+        self.queries = 0
+        self.socks = []
+        self.listener = socket(AF_UNIX)
+        self.listener.bind(path)
+        self.listener.listen(8)
+        threading.Thread(target = self.accept, daemon = True).start()
+
+    def accept(self):
+        while True:
+            sock, _ = self.listener.accept()
+            self.socks.append(sock)
+            threading.Thread(target = self.serve, args = (sock, threading.Lock()), daemon = True).start()
+
+    def close(self):
+        for sock in self.socks:
+            sock.shutdown(SHUT_RDWR)
+
+    def send(self, sock, lock, msg_type, payload):
+        data = json.dumps(payload).encode()
+        with lock:
+            sock.sendall(HEADER.pack(MAGIC, len(data), msg_type) + data)
+
+    def reply(self, sock, lock, msg_type):
+        if msg_type == MSG["workspaces"]:
+            payload = [workspace(1, 1, "A", True, True), workspace(2, 2, "A")]
+        elif msg_type == MSG["outputs"]:
+            # a different output size for every query, so every applied reply
+            # is a change
+            rect = dict(RECT, width = 1000 + self.queries)
+            payload = [{"name": "A", "rect": rect, "active": True, "primary": True}]
+        elif msg_type == MSG["tree"]:
+            ws = workspace(1, 1, "A", True, True)
+            ws["type"] = "workspace"
+            ws["nodes"] = [window(100, "title", True)]
+            payload = {"id": 0, "type": "root", "name": "root", "nodes": [ws], "floating_nodes": []}
+        else:
+            payload = {"success": True}
+        self.queries += 1
+        self.send(sock, lock, msg_type, payload)
+        if msg_type == MSG["subscribe"]:
+            threading.Thread(target = self.replay, args = (sock, lock), daemon = True).start()
+
+    def replay(self, sock, lock):
+        for seq in range(self.events):
+            if self.storm == "window":
+                msg_type = EVENT["window"]
+                payload = {"change": "title", "container": window(100, "title {}".format(seq), True)}
+            elif self.storm == "workspace":
+                msg_type = EVENT["workspace"]
+                cur, old = (1, 2) if seq % 2 == 0 else (2, 1)
+                payload = {"change": "focus", "current": workspace(cur, cur, "A"), "old": workspace(old, old, "A")}
+                payload["current"]["nodes"] = [window(100, "title")]
+            else:
+                msg_type = EVENT["output"]
+                payload = {"change": "unspecified"}
+            payload["seq"] = seq
+            self.sent[seq] = perf_counter()
+            self.send(sock, lock, msg_type, payload)
+
+    def serve(self, sock, lock):
+        buf = b""
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if data == b"":
+                return
+            buf += data
+            while len(buf) >= HEADER.size:
+                _, length, msg_type = HEADER.unpack_from(buf)
+                if len(buf) < HEADER.size + length:
+                    break
+                buf = buf[HEADER.size + length:]
+                self.reply(sock, lock, msg_type)
+
+class BenchModule(Module):
+    """
+    Records the latency from event write to "wm" event emit
+    """
+    name = "bench"
+
+    def __init__(self, server, wm_event):
+        super().__init__()
+        self.server = server
+        self.latencies = []
+        self.commands = []
+        self.received = 0
+        self.seq = None
+        self.listen("i3ipc", "event", self._event)
+        self.listen("wm", wm_event, self._emitted)
+
+    def _event(self, name, payload):
+        self.seq = payload["seq"]
+        self.received += 1
+        if self.received % 100 == 0:
+            start = perf_counter()
+            request = self.global_modules["i3ipc"].send_cmd("command", "nop")
+            request.add_done_callback(lambda payload: self.commands.append(perf_counter() - start))
+        if self.received == self.server.events:
+            # stop the daemon after the last event was handled
+            self.timeout(0.05, lambda late: self.server.close())
+
+    def _emitted(self, *args):
+        if self.seq != None:
+            self.latencies.append(perf_counter() - self.server.sent[self.seq])
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(storm, wm_event, events):
+    tmpdir = TemporaryDirectory()
+    path = os.path.join(tmpdir.name, "ipc.sock")
+    server = FakeI3(path, storm, events)
+
+    daemon = Daemon()
+    daemon.register(i3ipcModule(socketpath = path))
+    bench = BenchModule(server, wm_event)
+    daemon.register(bench)
+    daemon.register(i3Module(track_tree = storm == "window"))
+
+    blocks = sys.getallocatedblocks()
+    start = perf_counter()
+    daemon.run()
+    elapsed = perf_counter() - start - 0.05
+    blocks = sys.getallocatedblocks() - blocks
+
+    daemon.close()
+    server.listener.close()
+    tmpdir.cleanup()
+    return {
+        "storm": storm,
+        "events/s": bench.received / elapsed,
+        "emits": len(bench.latencies),
+        "queries": server.queries,
+        "p50 ms": percentile(bench.latencies, 0.5) * 1000,
+        "p99 ms": percentile(bench.latencies, 0.99) * 1000,
+        "cmd ms": percentile(bench.commands, 0.5) * 1000,
+        "blocks/event": blocks / max(bench.received, 1)
+    }
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    columns = ["storm", "events/s", "emits", "queries", "p50 ms", "p99 ms", "cmd ms", "blocks/event"]
+    print(" ".join("{:>12}".format(column) for column in columns))
+    for storm, wm_event in [("window", "title"), ("workspace", "workspaces"), ("output", "monitors")]:
+        result = run(storm, wm_event, events)
+        print(" ".join(
+            "{:>12}".format(result[column]) if type(result[column]) != float
+                else "{:>12.3f}".format(result[column])
+            for column in columns
+        ))
+
+if __name__ == "__main__":
+    main()
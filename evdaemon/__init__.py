@@ -1,3 +1,5 @@
 from .version import __version__
 from .daemon import Daemon
 from .module import Module
+from .profiler import Profiler
+from .writer import Writer
@@ -0,0 +1,94 @@
+from asyncio import iscoroutine
+from collections import OrderedDict
+from time import perf_counter
+
+from .hooks import Hooks
+
+class CoalescedListener(object):
+    """
+    A listener that only passes on the last of many events
+
+    Returned by Module.listen_coalesced(). Events are coalesced per rest
+    path (the leading arguments that are one of Hooks.subhook_types), so
+    ("wm", "title") does not replace a pending ("wm", "workspaces"), while
+    payloads after the rest path are replaced. At the end of the loop
+    iteration the listener function is called once for each rest path with
+    its latest arguments, in the order the paths first arrived. With a
+    window, deliveries are at least window seconds apart, events in between
+    are delivered when the window is over
+
+    Attributes:
+    - module: the module listening
+    - fn: the listener function
+    - window: the minimum number of seconds between calls
+    """
+    def __init__(self, module, fn, window = 0):
+        self.module = module
+        self.fn = fn
+        self.window = window
+
+        self._args = OrderedDict()
+        self._pending = False
+        self._timeout = None
+        self._last_call = None
+
+    def pending(self):
+        """
+        Returns whether an event waits to be delivered
+        """
+        return self._pending
+
+    def cancel(self):
+        """
+        Drop the waiting events
+
+        Called by Module.remove()
+        """
+        if self._timeout != None:
+            self._timeout.cancel()
+            self._timeout = None
+        self._args.clear()
+        self._pending = False
+
+    def __call__(self, *args):
+        self._args[self._rest_path(args)] = args
+        if self._pending:
+            return
+        self._pending = True
+        wait = 0
+        if self.window > 0 and self._last_call != None:
+            wait = self._last_call + self.window - perf_counter()
+        if wait > 0:
+            self._timeout = self.module.timeout(wait, lambda late: self._deliver())
+        else:
+            self.module.defer(self._deliver)
+
+    def __str__(self):
+        return "<CoalescedListener {} window={}>".format(self.fn, self.window)
+    def __repr__(self):
+        return str(self)
+
+    # private API
+
+    def _rest_path(self, args):
+        types = Hooks.subhook_types
+        i = 0
+        for arg in args:
+            if type(arg) not in types:
+                return args[:i]
+            i += 1
+        return args
+
+    def _deliver(self):
+        if not self._pending:
+            # cancelled after the delivery was deferred
+            return
+        pending = self._args
+        self._args = OrderedDict()
+        self._pending = False
+        self._timeout = None
+        self._last_call = perf_counter()
+        for args in pending.values():
+            result = self.fn(*args)
+            if result is not None and iscoroutine(result):
+                self.module.spawn(result)
@@ -1,22 +1,95 @@
-from functools import reduce
-from select import select
+from asyncio import get_event_loop
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heapify, heappop, heappush
+from itertools import count
+from os import close, pipe, read, set_blocking, write
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
 from time import perf_counter
 
-from .state import State
+from .state import State, snapshot
+from .timeout import aligned_deadline
 
 class Daemon(object):
     """
     An event loop daemon (evd)
 
     Daemon modules can be registered and they are woken up when opened files
-    can be read or events fire
+    can be read or written or events fire
+
+    Files are kept registered with a selector (epoll where available) for as
+    long as their module has them registered, so waiting for readiness does
+    not depend on the total number of files. Each registration carries the
+    owning module and the read and write event paths, so a ready file is
+    dispatched directly
+
+    Emitted events are only passed to modules that listen on the first
+    component of the event path (or on all events)
+
+    Events are passed to listeners as soon as they are emitted, unless
+    queue_events is set. Queued events are passed on in order after the
+    ready files and timeouts of a loop iteration were handled, for at most
+    emit_budget seconds per iteration, so a long cascade of events does not
+    delay timeouts and files. Events emitted from listeners nested deeper
+    than max_emit_depth are always queued
+
+    Timeouts of all modules are kept in a single heap, cancelled timeouts are
+    left in the heap and skipped when they reach the top. Timeouts may fire up
+    to their slack seconds late: a second heap orders them by the latest
+    time they may fire, the daemon sleeps until the earliest of those and
+    then fires all timeouts that are due, so timeouts with overlapping slack
+    share a wakeup
+
+    The daemon can either run its own loop with run() or be driven by an
+    asyncio event loop with run_async(). In the latter case, files are
+    watched with loop.add_reader(), the earliest timeout is scheduled with
+    loop.call_at() and listeners may be coroutines
+
+    Functions can be run on a pool of at most max_threads threads with
+    Module.run_in_thread(). Results and calls from other threads are passed
+    back to the loop through a pipe registered with the selector
+
+    Registering a Profiler module times all listener and timeout calls
 
     Attributes:
-    - state: contains the state object of all loaded modules
+    - state: contains the state object of all loaded modules, its version
+      counts the state writes of all modules
     """
-    def __init__(self):
+    def __init__(self, max_threads = 4, queue_events = False, emit_budget = 0.01, max_emit_depth = 32):
         self.modules = {}
         self.state = State()
+        self.max_threads = max_threads
+        self.queue_events = queue_events
+        self.emit_budget = emit_budget
+        self.max_emit_depth = max_emit_depth
+
+        self._subscribers = {}
+        self._catchall = ()
+        self._selector = DefaultSelector()
+        self._timers = []
+        self._timers_dead = 0
+        self._wakeups = []
+        self._wakeups_dead = 0
+        self._timer_seq = count()
+        self._profiler = None
+        self._deferred = OrderedDict()
+        self._events = deque()
+        self._emit_depth = 0
+
+        self._executor = None
+        self._jobs = 0
+        self._calls = deque()
+        self._wakeup_read, self._wakeup_write = pipe()
+        set_blocking(self._wakeup_read, False)
+        set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, EVENT_READ, (None, None, None))
+
+        self._loop = None
+        self._loop_done = None
+        self._loop_timer = None
+        self._loop_deadline = None
+        self._loop_checking = False
+        self._tasks = set()
     
     # public API
 
@@ -32,6 +105,16 @@ class Daemon(object):
             module.register_daemon(self)
             setattr(self.state, module.name, module.state)
             self.modules[module.name] = module
+            self._update_module_subscriptions(module)
+            module._hooks.profiler = self._profiler
+            module._hooks_private.profiler = self._profiler
+            registered = self._selector.get_map()
+            for file in set(module._files) | set(module._writable):
+                if file not in registered:
+                    self._update_file(module, file)
+            for to in module._timeouts:
+                if to._daemon == None:
+                    self._schedule(to)
 
     def unregister(self, module):
         """
@@ -43,16 +126,80 @@ class Daemon(object):
             module.unregister_daemon(self)
             delattr(self.state, module.name)
             del self.modules[module.name]
+            self._update_module_subscriptions(module)
+            module._hooks.profiler = None
+            module._hooks_private.profiler = None
+            for key in list(self._selector.get_map().values()):
+                if key.data[0] is module:
+                    self._unregister_file(key.fileobj)
+            for to in module._timeouts:
+                if to._daemon is self:
+                    self._unschedule(to)
         else:
             raise ValueError("this module is not registered")
 
     def emit(self, *path):
         """
         Emit an event to all listening modules
+
+        With queue_events, or when called from deeply nested listeners, the
+        event is queued and passed on later in the loop iteration
         """
-        path = list(path)
-        for module in self.modules.values():
-            module.emit_local(*path)
+        if self.queue_events or self._emit_depth >= self.max_emit_depth:
+            self._events.append(path)
+            self._async_check()
+        else:
+            self._emit(path)
+
+    def call_threadsafe(self, fn, *args):
+        """
+        Call fn with args on the thread running the daemon
+
+        Can be called from any thread, wakes the daemon up if it is waiting
+        """
+        self._calls.append((fn, args))
+        try:
+            write(self._wakeup_write, b"\0")
+        except BlockingIOError:
+            # the pipe is full, so the daemon is woken up anyway
+            pass
+
+    def defer(self, fn):
+        """
+        Call fn once at the end of the current loop iteration
+
+        Deferring a function that is already deferred does nothing, so work
+        requested by many events can be done once per iteration
+        """
+        self._deferred[fn] = None
+        self._async_check()
+
+    def emit_threadsafe(self, *path):
+        """
+        Emit an event from any thread
+
+        The event is emitted on the thread running the daemon
+        """
+        self.call_threadsafe(self.emit, *path)
+
+    def snapshot(self):
+        """
+        Returns an immutable snapshot of the daemon state
+
+        Module states that did not change since the last snapshot share
+        their snapshots. Snapshots can be read from other threads, but have
+        to be taken on the thread running the daemon
+        """
+        return snapshot(self.state)
+
+    def has_listeners(self, *path):
+        """
+        Returns whether emitting an event would call any listener
+        """
+        for module in self._listening_modules(path):
+            if module._hooks.has_listeners(path):
+                return True
+        return False
 
     def run(self):
         """
@@ -60,65 +207,381 @@ class Daemon(object):
         """
         if len(self.modules) == 0:
             raise ValueError("no modules registered")
+        self._run_pending()
         while True:
-            if not self._has_files() and not self._has_timeouts():
+            if not self._has_files() and not self._has_timeouts() and self._jobs == 0 and len(self._events) == 0:
                 break
-            timeout = self._calculate_timeout()
-            ready, _, _ = select(self._files(), [], [], timeout)
+            timeout = 0 if len(self._events) != 0 else self._calculate_timeout()
+            ready = self._selector.select(timeout)
+            start = perf_counter()
             self._dispatch_timeouts()
-            for file in ready:
-                self._trigger_file(file)
+            for key, events in ready:
+                self._trigger_file(key, events)
+            self._run_pending()
+            if self._profiler != None:
+                self._profiler._iteration(start)
+
+    def close(self):
+        """
+        Close the wakeup pipe and the selector and shut down the thread pool
+
+        Waits for running thread jobs. The daemon cannot be used afterwards
+        """
+        if self._executor != None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._wakeup_read != None:
+            self._selector.unregister(self._wakeup_read)
+            close(self._wakeup_read)
+            close(self._wakeup_write)
+            self._wakeup_read = None
+            self._wakeup_write = None
+        self._selector.close()
+
+    async def run_async(self):
+        """
+        Run the event loop on the current asyncio event loop
+
+        Returns when no timeouts, registered files, thread jobs or coroutine
+        listeners remain. Exceptions raised by listeners end the run and are raised
+        from here
+        """
+        if len(self.modules) == 0:
+            raise ValueError("no modules registered")
+        if self._loop != None:
+            raise RuntimeError("daemon is already running")
+
+        loop = get_event_loop()
+        self._loop = loop
+        self._loop_done = loop.create_future()
+        try:
+            for key in self._selector.get_map().values():
+                self._async_watch(key, 0, key.events)
+            self._async_update()
+            await self._loop_done
+        finally:
+            for key in self._selector.get_map().values():
+                loop.remove_reader(key.fd)
+                loop.remove_writer(key.fd)
+            if self._loop_timer != None:
+                self._loop_timer.cancel()
+            for task in self._tasks:
+                task.cancel()
+            self._tasks.clear()
+            self._loop = None
+            self._loop_done = None
+            self._loop_timer = None
+            self._loop_deadline = None
+            self._loop_checking = False
 
     # private API
 
-    def _has_timeouts(self):
+    def _listening_modules(self, path):
+        if len(self._catchall) != 0:
+            return self.modules.values()
+        elif len(path) != 0:
+            try:
+                return self._subscribers.get(path[0], ())
+            except TypeError:
+                return ()
+        else:
+            return ()
+
+    def _set_profiler(self, profiler):
+        self._profiler = profiler
         for module in self.modules.values():
-            if len(module.timeouts()) != 0:
-                return True
-        return False
+            module._hooks.profiler = profiler
+            module._hooks_private.profiler = profiler
 
-    def _calculate_timeout(self):
-        now = perf_counter()
-        first_tos = sorted(
-            module.timeouts()[0]
-                for module in self.modules.values()
-                if len(module.timeouts()) != 0
+    def _run_in_thread(self, module, fn, path):
+        if self._executor == None:
+            self._executor = ThreadPoolExecutor(self.max_threads)
+        future = self._executor.submit(fn)
+        self._jobs += 1
+        future.add_done_callback(
+            lambda future: self.call_threadsafe(self._job_done, module, future, path)
         )
-        if len(first_tos) == 0:
-            return None
-        elif first_tos[0][0] - now <= 0:
-            return 0
+        return future
+
+    def _job_done(self, module, future, path):
+        self._jobs -= 1
+        if not future.cancelled():
+            module.emit_private(*path, future.result())
+
+    def _emit(self, path):
+        self._emit_depth += 1
+        try:
+            for module in self._listening_modules(path):
+                module._hooks.emit(path)
+        finally:
+            self._emit_depth -= 1
+
+    def _run_pending(self):
+        """
+        pass on queued events within the emit budget, then call deferred
+        functions
+        """
+        events = self._events
+        if len(events) != 0:
+            deadline = perf_counter() + self.emit_budget
+            while len(events) != 0:
+                self._emit(events.popleft())
+                if perf_counter() >= deadline:
+                    break
+        self._run_deferred()
+
+    def _run_deferred(self):
+        while len(self._deferred) != 0:
+            deferred = self._deferred
+            self._deferred = OrderedDict()
+            for fn in deferred:
+                fn()
+
+    def _run_calls(self):
+        try:
+            while True:
+                read(self._wakeup_read, 4096)
+        except BlockingIOError:
+            pass
+        calls = self._calls
+        for _ in range(len(calls)):
+            fn, args = calls.popleft()
+            fn(*args)
+
+    def _spawn(self, module, coro):
+        if self._loop == None:
+            coro.close()
+            raise RuntimeError("coroutines can only be run with Daemon.run_async()")
+        task = self._loop.create_task(coro)
+        task.add_done_callback(lambda task: self._async_call(self._task_done, module, task))
+        self._tasks.add(task)
+        return task
+
+    def _task_done(self, module, task):
+        self._tasks.discard(task)
+        if not task.cancelled():
+            result = task.result()
+            if type(result) == tuple:
+                module.emit(*result)
+
+    def _async_call(self, fn, *args):
+        if self._loop_done == None or self._loop_done.done():
+            return
+        start = perf_counter()
+        try:
+            fn(*args)
+            self._run_pending()
+        except BaseException as e:
+            self._loop_done.set_exception(e)
+            return
+        if self._profiler != None:
+            self._profiler._iteration(start)
+        self._async_update()
+
+    def _async_check(self):
+        # re-check for remaining work after changes made outside of daemon
+        # callbacks, e.g. by other asyncio tasks
+        if self._loop != None and not self._loop_checking:
+            self._loop_checking = True
+            self._loop.call_soon(self._async_call, self._async_checked)
+
+    def _async_checked(self):
+        self._loop_checking = False
+
+    def _async_watch(self, key, old, new):
+        loop = self._loop
+        if new & EVENT_READ and not old & EVENT_READ:
+            loop.add_reader(key.fd, self._async_call, self._trigger_file, key, EVENT_READ)
+        elif old & EVENT_READ and not new & EVENT_READ:
+            loop.remove_reader(key.fd)
+        if new & EVENT_WRITE and not old & EVENT_WRITE:
+            loop.add_writer(key.fd, self._async_call, self._trigger_file, key, EVENT_WRITE)
+        elif old & EVENT_WRITE and not new & EVENT_WRITE:
+            loop.remove_writer(key.fd)
+        if new == 0:
+            self._async_check()
+
+    def _async_update(self):
+        if not self._has_files() and not self._has_timeouts() and self._jobs == 0 and len(self._tasks) == 0 and len(self._events) == 0:
+            self._loop_done.set_result(None)
         else:
-            return first_tos[0][0] - now
+            if len(self._events) != 0:
+                # continue with the queued events after other callbacks ran
+                self._async_check()
+            self._async_arm()
+
+    def _async_arm(self):
+        timeout = self._calculate_timeout()
+        deadline = self._wakeups[0][0] if timeout != None else None
+        if deadline == self._loop_deadline:
+            return
+        if self._loop_timer != None:
+            self._loop_timer.cancel()
+            self._loop_timer = None
+        self._loop_deadline = deadline
+        if timeout != None:
+            self._loop_timer = self._loop.call_at(
+                self._loop.time() + timeout,
+                self._async_call, self._async_timeouts
+            )
+
+    def _async_timeouts(self):
+        self._loop_timer = None
+        self._loop_deadline = None
+        self._dispatch_timeouts()
+
+    def _update_subscriptions(self, path):
+        if len(path) == 0:
+            self._catchall = tuple(
+                module for module in self.modules.values()
+                    if len(module._hooks.listeners) != 0
+            )
+        else:
+            name = path[0]
+            modules = tuple(
+                module for module in self.modules.values()
+                    if name in module._hooks.subhooks
+            )
+            if len(modules) != 0:
+                self._subscribers[name] = modules
+            elif name in self._subscribers:
+                del self._subscribers[name]
+
+    def _update_module_subscriptions(self, module):
+        hooks = module._hooks
+        if len(hooks.listeners) != 0:
+            self._update_subscriptions(())
+        for name in hooks.subhooks:
+            self._update_subscriptions((name,))
+
+    def _schedule(self, to):
+        seq = next(self._timer_seq)
+        entry = [to.deadline, seq, to]
+        wakeup = [to.deadline + to.slack, seq, to]
+        to._daemon = self
+        to._entry = entry
+        to._wakeup = wakeup
+        heappush(self._timers, entry)
+        heappush(self._wakeups, wakeup)
+        if self._loop != None:
+            self._async_arm()
+
+    def _unschedule(self, to):
+        to._entry[2] = None
+        to._wakeup[2] = None
+        to._daemon = None
+        to._entry = None
+        to._wakeup = None
+        self._timers_dead += 1
+        self._wakeups_dead += 1
+        self._async_check()
+        if self._timers_dead > 64 and self._timers_dead * 2 > len(self._timers):
+            self._timers[:] = [entry for entry in self._timers if entry[2] != None]
+            heapify(self._timers)
+            self._timers_dead = 0
+        if self._wakeups_dead > 64 and self._wakeups_dead * 2 > len(self._wakeups):
+            self._wakeups[:] = [entry for entry in self._wakeups if entry[2] != None]
+            heapify(self._wakeups)
+            self._wakeups_dead = 0
+
+    def _has_timeouts(self):
+        return len(self._timers) > self._timers_dead
+
+    def _calculate_timeout(self):
+        # sleep until the first timeout runs out of slack, all timeouts that
+        # are due by then fire in the same wakeup
+        wakeups = self._wakeups
+        while len(wakeups) != 0 and wakeups[0][2] == None:
+            heappop(wakeups)
+            self._wakeups_dead -= 1
+        if len(wakeups) == 0:
+            return None
+        return max(wakeups[0][0] - perf_counter(), 0)
 
     def _dispatch_timeouts(self):
         now = perf_counter()
-        for module in self.modules.values():
-            tos = module.timeouts()
-            while len(tos) != 0:
-                ready_time, fn = tos[0]
-                if now > ready_time:
-                    fn(ready_time - now)
-                    tos.pop(0)
+        timers = self._timers
+        while len(timers) != 0 and now > timers[0][0]:
+            ready_time, _, to = heappop(timers)
+            if to == None:
+                self._timers_dead -= 1
+                continue
+            to._wakeup[2] = None
+            self._wakeups_dead += 1
+            to._daemon = None
+            to._entry = None
+            to._wakeup = None
+            if to.interval == None:
+                to.module._timeouts.discard(to)
+            else:
+                if to.align:
+                    to.deadline = aligned_deadline(to.interval, now, True)
                 else:
-                    break
+                    to.deadline += to.interval
+                    if to.deadline <= now:
+                        missed = (now - to.deadline) // to.interval + 1
+                        to.deadline += missed * to.interval
+                self._schedule(to)
+            if self._profiler != None:
+                self._profiler._call_timeout(to, ready_time - now)
+            else:
+                to._fn(ready_time - now)
 
-    def _has_files(self):
-        for module in self.modules.values():
-            if len(module.files()) != 0:
-                return True
-        return False
+    def _update_file(self, module, file):
+        """
+        register, modify or unregister a file to match the read and write
+        paths of its module
+        """
+        events = 0
+        if file in module._files:
+            events |= EVENT_READ
+        if file in module._writable:
+            events |= EVENT_WRITE
+        data = (module, module._files.get(file), module._writable.get(file))
+        try:
+            old = self._selector.get_key(file)
+        except KeyError:
+            old = None
 
-    def _files(self):
-        return list(reduce(
-            lambda acc, module: acc + list(module.files()),
-            list(self.modules.values()),
-            []
-        ))
+        if old == None:
+            if events == 0:
+                return
+            key = self._selector.register(file, events, data)
+            old_events = 0
+        elif events == 0:
+            self._unregister_file(file)
+            return
+        else:
+            key = self._selector.modify(file, events, data)
+            old_events = old.events
+        if self._loop != None:
+            self._async_watch(key, old_events, events)
 
-    def _trigger_file(self, file):
-        for module in self.modules.values():
-            if file in module.files():
-                module.trigger_file(file)
+    def _unregister_file(self, file):
+        key = self._selector.unregister(file)
+        if self._loop != None:
+            self._async_watch(key, key.events, 0)
+
+    def _has_files(self):
+        # the wakeup pipe is always registered
+        return len(self._selector.get_map()) > 1
+
+    def _trigger_file(self, key, events):
+        # the file may have been unregistered or changed by an earlier
+        # handler in the same iteration
+        registered = self._selector.get_map()
+        current = registered.get(key.fd)
+        if current == None or current.fileobj is not key.fileobj:
+            return
+        module, path, write_path = current.data
+        if module == None:
+            self._run_calls()
+            return
+        if events & EVENT_READ and path != None:
+            module.emit_private(*path)
+            current = registered.get(key.fd)
+            if current == None or current.fileobj is not key.fileobj:
                 return
-        raise ValueError("file not registered to any module: {}".format(file))
+            write_path = current.data[2]
+        if events & EVENT_WRITE and write_path != None:
+            module.emit_private(*write_path)
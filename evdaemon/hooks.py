@@ -1,3 +1,5 @@
+from asyncio import iscoroutine
+
 class Hooks(object):
     """
     An event hook container
@@ -5,14 +7,34 @@ class Hooks(object):
     Contains a number of direct hooks and subhooks.
     Only subhook_types can be used to as a subhook filter
 
+    Emitting resolves a path to the flat list of matching listeners once and
+    caches it by the part of the path that can match a subhook, which ends
+    at the first segment that is not one of the subhook_types (so 1, True
+    and 1.0 do not share an entry). listen() and
+    remove() invalidate the cache. The listeners of an emit are fixed when the
+    emit starts, listeners added or removed by a listener take effect on the
+    next emit
+
+    Listeners may be coroutine functions, the coroutines they return are
+    passed to spawn
+
     Attributes:
     - subhook_types: can be used as a subhook filter
+    - cache_size: the number of resolved paths kept before the cache is reset
+    - spawn: called with coroutines returned by listeners
+    - profiler: a Profiler that times listener calls, or None
     """
-    subhook_types = [int, str]
+    subhook_types = frozenset([int, str])
+    cache_size = 1024
 
-    def __init__(self):
+    def __init__(self, spawn = None):
         self.listeners = []
         self.subhooks = {}
+        self.spawn = spawn
+        self.profiler = None
+
+        self._depth = 0
+        self._cache = {}
 
     def listen(self, path, listener):
         """
@@ -20,16 +42,9 @@ class Hooks(object):
 
         Creates subhooks if the path is not direct
         """
-        if len(path) == 0:
-            if listener not in self.listeners:
-                self.listeners.append(listener)
-            else:
-                raise ValueError("listener already registered for this event")
-        else:
-            name = path.pop(0)
-            if name not in self.subhooks:
-                self.subhooks[name] = Hooks()
-            self.subhooks[name].listen(path, listener)
+        self._listen(path, 0, listener)
+        self._depth = max(self._depth, len(path))
+        self._cache.clear()
 
     def remove(self, path, listener):
         """
@@ -38,28 +53,113 @@ class Hooks(object):
         Removes a subhook if that subhook no longer has listeners or
         subsubhooks
         """
-        if len(path) == 0:
+        self._remove(path, 0, listener)
+        self._depth = self._max_depth()
+        self._cache.clear()
+
+    def emit(self, path):
+        """
+        Emits an event on a path to all matching listeners
+
+        path has to be a tuple
+        """
+        try:
+            matches = self._cache[self._key(path)]
+        except KeyError:
+            matches = self._matches(path)
+
+        profiler = self.profiler
+        for listener, depth in matches:
+            if profiler == None:
+                result = listener(*path[depth:])
+            else:
+                result = profiler._call(listener, path, depth)
+            if result is not None and iscoroutine(result):
+                if self.spawn == None:
+                    result.close()
+                    raise RuntimeError("coroutine listener without a spawn function")
+                self.spawn(result)
+
+    def has_listeners(self, path):
+        """
+        Returns whether emitting path would call any listener
+        """
+        return len(self._matches(path)) != 0
+
+    # private API
+
+    def _key(self, path):
+        """
+        the part of path that can match a subhook
+
+        resolving stops at the first segment of another type, so the
+        listeners only depend on the segments before it
+        """
+        key = path[:self._depth]
+        types = self.subhook_types
+        i = 0
+        for segment in key:
+            if type(segment) not in types:
+                return key[:i]
+            i += 1
+        return key
+
+    def _matches(self, path):
+        key = self._key(path)
+        try:
+            return self._cache[key]
+        except KeyError:
+            matches = self._resolve(path)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[key] = matches
+            return matches
+
+    def _listen(self, path, i, listener):
+        if i == len(path):
+            if listener not in self.listeners:
+                self.listeners.append(listener)
+            else:
+                raise ValueError("listener already registered for this event")
+        else:
+            name = path[i]
+            if name not in self.subhooks:
+                self.subhooks[name] = Hooks()
+            self.subhooks[name]._listen(path, i + 1, listener)
+
+    def _remove(self, path, i, listener):
+        if i == len(path):
             if listener in self.listeners:
                 self.listeners.remove(listener)
             else:
                 raise ValueError("cannot remove nonexisting listener")
         else:
-            name = path.pop(0)
+            name = path[i]
             if name in self.subhooks:
                 subhook = self.subhooks[name]
-                subhook.remove(path, listener)
+                subhook._remove(path, i + 1, listener)
                 if len(subhook.listeners) + len(subhook.subhooks) == 0:
                     del self.subhooks[name]
             else:
                 raise ValueError("cannot remove nonexisting listener")
 
-    def emit(self, path):
-        """
-        Emits an event on a path to all matching listeners
-        """
-        for listener in self.listeners:
-            listener(*path)
-        if len(path) > 0:
-            name = path.pop(0)
-            if type(name) in self.subhook_types and name in self.subhooks:
-                self.subhooks[name].emit(path)
+    def _max_depth(self):
+        if len(self.subhooks) == 0:
+            return 0
+        return 1 + max(subhook._max_depth() for subhook in self.subhooks.values())
+
+    def _resolve(self, path):
+        matches = []
+        hooks = self
+        depth = 0
+        while True:
+            for listener in hooks.listeners:
+                matches.append((listener, depth))
+            if depth == len(path):
+                break
+            name = path[depth]
+            if type(name) not in self.subhook_types or name not in hooks.subhooks:
+                break
+            hooks = hooks.subhooks[name]
+            depth += 1
+        return tuple(matches)
@@ -1,7 +1,9 @@
 from time import perf_counter
 
+from .coalesce import CoalescedListener
 from .hooks import Hooks
 from .state import State
+from .timeout import Timeout, aligned_deadline
 
 class Module(object):
     """
@@ -14,6 +16,7 @@ class Module(object):
 
     Event facilites:
     - emit/listen/remove(): emits to or listens on the global daemon or removes such a listener
+      (listeners may be coroutine functions when the daemon runs on asyncio)
     - emit_local(): emits an event only to the local module, listen and remove as above
     - emit_private/listen_private/remove_private(): emits or listens on a private event only to the local module
     """
@@ -28,10 +31,11 @@ class Module(object):
         self.state = State()
 
         self._daemon = None
-        self._hooks = Hooks()
-        self._hooks_private = Hooks()
+        self._hooks = Hooks(self.spawn)
+        self._hooks_private = Hooks(self.spawn)
         self._files = {}
-        self._timeouts = []
+        self._writable = {}
+        self._timeouts = set()
    
     # public API
 
@@ -55,9 +59,10 @@ class Module(object):
         """
         Register a file to emit an event when it can be read
         """
-        path = list(path)
         if file not in self._files:
             self._files[file] = path
+            if self._daemon != None:
+                self._daemon._update_file(self, file)
         else:
             raise ValueError("file already registered")
 
@@ -67,9 +72,36 @@ class Module(object):
         """
         if file in self._files:
             del self._files[file]
+            if self._daemon != None:
+                self._daemon._update_file(self, file)
         else:
             raise ValueError("file not registered")
 
+    def register_writable(self, file, *path):
+        """
+        Register a file to emit an event when it can be written
+
+        Unregister it when there is nothing to write, or the event keeps
+        firing
+        """
+        if file not in self._writable:
+            self._writable[file] = path
+            if self._daemon != None:
+                self._daemon._update_file(self, file)
+        else:
+            raise ValueError("file already registered for writing")
+
+    def unregister_writable(self, file):
+        """
+        Unregister a file from emitting write events
+        """
+        if file in self._writable:
+            del self._writable[file]
+            if self._daemon != None:
+                self._daemon._update_file(self, file)
+        else:
+            raise ValueError("file not registered for writing")
+
     def files(self):
         """
         Returns all registered files
@@ -87,23 +119,81 @@ class Module(object):
 
     def timeouts(self):
         """
-        Return all timeouts on this module
+        Return all pending timeouts on this module, ordered by deadline
         """
-        return self._timeouts
+        return sorted(self._timeouts, key = lambda to: to.deadline)
 
-    def timeout(self, secs, fn):
+    def timeout(self, secs, fn, slack = 0):
         """
         Run a function after some timeout
+
+        The function may run up to slack seconds late, so the daemon can wake
+        up once for several timeouts. Returns a Timeout handle that can be
+        cancelled
+        """
+        return self._add_timeout(Timeout(self, perf_counter() + secs, fn, slack = slack))
+
+    def interval(self, secs, fn, slack = 0, align = False):
+        """
+        Run a function every secs seconds
+
+        Deadlines are computed from the previous deadline, not from the time
+        the function ran, so the interval does not drift. Missed deadlines are
+        skipped. With align, deadlines are multiples of secs on the wall
+        clock (e.g. on every full second or minute). Returns a Timeout handle
+        that can be cancelled
+        """
+        if secs <= 0:
+            raise ValueError("interval has to be positive")
+        now = perf_counter()
+        deadline = aligned_deadline(secs, now) if align else now + secs
+        return self._add_timeout(Timeout(self, deadline, fn, secs, slack, align))
+
+    def spawn(self, coro):
+        """
+        Run a coroutine as a task on the daemon's asyncio event loop
+
+        Only possible while the daemon runs with Daemon.run_async(). If the
+        coroutine returns a tuple, it is emitted as an event path. Coroutine
+        listeners are spawned automatically
+        """
+        if self._daemon != None:
+            return self._daemon._spawn(self, coro)
+        else:
+            coro.close()
+            raise ValueError("module not yet registered to an event daemon")
+
+    def defer(self, fn):
+        """
+        Call fn once at the end of the current daemon loop iteration
+        """
+        if self._daemon != None:
+            self._daemon.defer(fn)
+        else:
+            raise ValueError("module not yet registered to an event daemon")
+
+    def run_in_thread(self, fn, *path):
+        """
+        Run a function on the daemon's thread pool
+
+        When it returns, its result is emitted privately as the last argument
+        of path. Exceptions are raised on the daemon thread. Returns a
+        concurrent.futures.Future
         """
-        to = (perf_counter() + secs, fn)
-        self._timeouts.append(to)
-        self._timeouts.sort(key = lambda to: to[0])
+        if self._daemon != None:
+            return self._daemon._run_in_thread(self, fn, path)
+        else:
+            raise ValueError("module not yet registered to an event daemon")
 
     def listen(self, *path):
         """
         Listen on events of a specific type
         """
-        return self._listen_imp(self._hooks, path)
+        subscribed = self._subscribed(path[:-1])
+        listener = self._listen_imp(self._hooks, path)
+        if self._daemon != None and not subscribed:
+            self._daemon._update_subscriptions(path[:-1])
+        return listener
 
     def listen_once(self, *path):
         """
@@ -117,11 +207,30 @@ class Module(object):
             fn(*args)
         return self.listen(*path, listener_once)
 
+    def listen_coalesced(self, *path, window = 0):
+        """
+        Listen on events of a specific type, but only handle the latest one
+
+        The listener is called once at the end of the loop iteration with the
+        arguments of the last event for each rest path. With a window, calls
+        are at least window seconds apart. Returns the CoalescedListener,
+        remove it with remove()
+        """
+        path = list(path)
+        fn = path.pop()
+        return self.listen(*path, CoalescedListener(self, fn, window))
+
     def remove(self, *path):
         """
         Remove a listener on a specific path
+
+        Events still waiting in a removed CoalescedListener are dropped
         """
         self._remove_imp(self._hooks, path)
+        if len(path) != 0 and isinstance(path[-1], CoalescedListener):
+            path[-1].cancel()
+        if self._daemon != None and not self._subscribed(path[:-1]):
+            self._daemon._update_subscriptions(path[:-1])
 
     def emit(self, *path):
         """
@@ -132,11 +241,21 @@ class Module(object):
         else:
             raise ValueError("module not yet registered to an event daemon")
 
+    def has_listeners(self, *path):
+        """
+        Returns whether emitting an event to the global daemon would call any
+        listener
+        """
+        if self._daemon != None:
+            return self._daemon.has_listeners(*path)
+        else:
+            raise ValueError("module not yet registered to an event daemon")
+
     def emit_local(self, *path):
         """
         Emit an event only to this module
         """
-        self._hooks.emit(list(path))
+        self._hooks.emit(path)
     
     def listen_private(self, *path):
         """
@@ -168,7 +287,7 @@ class Module(object):
         """
         Emit a private event only to this module
         """
-        self._hooks_private.emit(list(path))
+        self._hooks_private.emit(path)
 
     # private API
 
@@ -180,6 +299,24 @@ class Module(object):
         hooks.listen(path, listener)
         return listener
 
+    def _subscribed(self, path):
+        if len(path) == 0:
+            return len(self._hooks.listeners) != 0
+        else:
+            return path[0] in self._hooks.subhooks
+
+    def _add_timeout(self, to):
+        self._timeouts.add(to)
+        if self._daemon != None:
+            self._daemon._schedule(to)
+        return to
+
+    def _cancel_timeout(self, to):
+        if to in self._timeouts:
+            self._timeouts.remove(to)
+            if to._daemon != None:
+                to._daemon._unschedule(to)
+
     def _remove_imp(self, hooks, path):
         path = list(path)
         if len(path) == 0:
@@ -0,0 +1,162 @@
+import sys
+from time import perf_counter
+
+from .module import Module
+
+class Stat(object):
+    """
+    Call count, cumulative and maximum time of something measured
+
+    Attributes:
+    - count: the number of measurements
+    - total: the sum of all measured seconds
+    - max: the largest measured seconds
+    """
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, secs):
+        """
+        Add a measurement
+        """
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+
+    def mean(self):
+        """
+        Returns the mean measured seconds
+        """
+        return self.total / self.count if self.count != 0 else 0.0
+
+    def __str__(self):
+        return "<Stat count={} total={} max={}>".format(self.count, self.total, self.max)
+    def __repr__(self):
+        return str(self)
+
+class Profiler(Module):
+    """
+    An evd module that measures listeners, timeouts and loop iterations
+
+    While registered, every listener and timeout call on the daemon is
+    timed. Listeners are identified by their qualified name, event paths by
+    the part of the path the listener subscribed to. Private events are
+    recorded like global ones
+
+    Calls that take longer than threshold seconds emit
+    ("profiler", "slow", name, path, secs). Emitting ("profiler", "dump")
+    prints the stats to stderr
+
+    Stats are updated in place and do not bump the state version
+
+    State:
+    - listeners: a dict of listener names to Stat
+    - paths: a dict of event paths to Stat
+    - timeouts: a dict of timeout function names to Stat
+    - lateness: Stat of the seconds timeouts fired after their deadline
+    - iterations: Stat of the seconds spent handling each loop iteration
+    - slow: Stat of the calls slower than threshold
+    """
+    name = "profiler"
+
+    def __init__(self, threshold = 0.05):
+        super().__init__()
+        self.threshold = threshold
+        self.reset()
+        self.listen("profiler", "dump", lambda: self.dump())
+
+        self._warning = False
+
+    def register_daemon(self, daemon):
+        super().register_daemon(daemon)
+        daemon._set_profiler(self)
+
+    def unregister_daemon(self, daemon):
+        super().unregister_daemon(daemon)
+        daemon._set_profiler(None)
+
+    def reset(self):
+        """
+        Clear all stats
+        """
+        self.state.listeners = {}
+        self.state.paths = {}
+        self.state.timeouts = {}
+        self.state.lateness = Stat()
+        self.state.iterations = Stat()
+        self.state.slow = Stat()
+
+    def dump(self, file = sys.stderr):
+        """
+        Print all stats, slowest first
+        """
+        state = self.state
+        row = "{:>10} {:>12} {:>12} {:>12}  {}"
+        print("[profiler]", "iterations:", state.iterations, file = file)
+        print("[profiler]", "lateness:", state.lateness, file = file)
+        print("[profiler]", "slow:", state.slow, file = file)
+        for title, stats in (("listener", state.listeners), ("path", state.paths), ("timeout", state.timeouts)):
+            print(row.format("count", "total ms", "mean ms", "max ms", title), file = file)
+            for name, stat in sorted(stats.items(), key = lambda item: -item[1].total):
+                print(row.format(
+                    stat.count,
+                    "{:.3f}".format(stat.total * 1000),
+                    "{:.3f}".format(stat.mean() * 1000),
+                    "{:.3f}".format(stat.max * 1000),
+                    name
+                ), file = file)
+
+    # private API
+
+    def _call(self, listener, path, depth):
+        start = perf_counter()
+        try:
+            return listener(*path[depth:])
+        finally:
+            secs = perf_counter() - start
+            name = _name(listener)
+            path = path[:depth]
+            self._stat(self.state.listeners, name).add(secs)
+            self._stat(self.state.paths, path).add(secs)
+            self._check(name, path, secs)
+
+    def _call_timeout(self, to, late):
+        self.state.lateness.add(-late)
+        start = perf_counter()
+        try:
+            to._fn(late)
+        finally:
+            secs = perf_counter() - start
+            name = _name(to._fn)
+            self._stat(self.state.timeouts, name).add(secs)
+            self._check(name, None, secs)
+
+    def _iteration(self, start):
+        self.state.iterations.add(perf_counter() - start)
+
+    def _stat(self, stats, key):
+        stat = stats.get(key)
+        if stat == None:
+            stat = stats[key] = Stat()
+        return stat
+
+    def _check(self, name, path, secs):
+        if self.threshold == None or secs <= self.threshold:
+            return
+        self.state.slow.add(secs)
+        if self._warning or self._daemon == None:
+            return
+        # slow listeners of slow events do not emit further slow events
+        self._warning = True
+        try:
+            self.emit("profiler", "slow", name, path, secs)
+        finally:
+            self._warning = False
+
+def _name(fn):
+    return getattr(fn, "__qualname__", None) or repr(fn)
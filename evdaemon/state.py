@@ -1,5 +1,112 @@
 class State(object):
     """
-    An empty state object
+    A state object
+
+    Every attribute write bumps the version of the state and of the state it
+    is stored in (module states are stored in the daemon state), so the
+    daemon state version counts all writes. Attributes starting with an
+    underscore are not tracked
+
+    Use version() to read the version, touch() to bump it after modifying a
+    value in place and snapshot() to get an immutable Snapshot
     """
-    pass
+    def __init__(self):
+        object.__setattr__(self, "_version", 0)
+        object.__setattr__(self, "_parent", None)
+        object.__setattr__(self, "_snapshot", None)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+            return
+        old = self.__dict__.get(name)
+        if isinstance(old, State) and old._parent is self:
+            object.__setattr__(old, "_parent", None)
+        if isinstance(value, State):
+            object.__setattr__(value, "_parent", self)
+        object.__setattr__(self, name, value)
+        touch(self)
+
+    def __delattr__(self, name):
+        old = self.__dict__.get(name)
+        if isinstance(old, State) and old._parent is self:
+            object.__setattr__(old, "_parent", None)
+        object.__delattr__(self, name)
+        if not name.startswith("_"):
+            touch(self)
+
+class Snapshot(object):
+    """
+    An immutable snapshot of a State
+
+    Snapshots of nested states are snapshots themselves. Values are shared
+    with the state, not copied
+    """
+    __slots__ = ("_values", "_version")
+
+    def __init__(self, values, version):
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "_version", version)
+
+    def __getattr__(self, name):
+        # unset slots (e.g. while copying) end up here, looking up _values
+        # again must not recurse
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("snapshots are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("snapshots are immutable")
+
+    def __reduce__(self):
+        return (Snapshot, (self._values, self._version))
+
+    def __dir__(self):
+        return list(self._values.keys())
+
+    def __repr__(self):
+        return "<Snapshot version={}>".format(self._version)
+
+def version(state):
+    """
+    Returns the version of a State or Snapshot
+    """
+    return state._version
+
+def touch(state):
+    """
+    Bumps the version of a State and the states containing it
+    """
+    while state != None:
+        object.__setattr__(state, "_version", state._version + 1)
+        state = state._parent
+
+def snapshot(state):
+    """
+    Returns an immutable Snapshot of a State
+
+    Snapshots of states that did not change since the last snapshot are
+    reused, so consecutive snapshots share unchanged parts. Values are not
+    copied: a snapshot stays consistent as long as values are replaced and
+    not modified in place
+    """
+    snap = state._snapshot
+    if snap != None and snap._version == state._version:
+        return snap
+
+    values = {}
+    for name, value in state.__dict__.items():
+        if name.startswith("_"):
+            continue
+        if isinstance(value, State):
+            value = snapshot(value)
+        values[name] = value
+    snap = Snapshot(values, state._version)
+    object.__setattr__(state, "_snapshot", snap)
+    return snap
@@ -0,0 +1,62 @@
+from time import time
+
+class Timeout(object):
+    """
+    A handle to a scheduled timeout
+
+    Returned by Module.timeout() and Module.interval(), can be used to cancel
+    the timeout before it fires
+
+    Attributes:
+    - module: the module the timeout belongs to
+    - deadline: the perf_counter() time at which the timeout fires next
+    - interval: the period in seconds for intervals, None for timeouts
+    - slack: the number of seconds the timeout may fire late, so it can
+      share a wakeup with other timeouts
+    - align: whether the interval is aligned to the wall clock
+    """
+    def __init__(self, module, deadline, fn, interval = None, slack = 0, align = False):
+        self.module = module
+        self.deadline = deadline
+        self.interval = interval
+        self.slack = slack
+        self.align = align
+        self._fn = fn
+        self._daemon = None
+        self._entry = None
+        self._wakeup = None
+
+    def cancel(self):
+        """
+        Cancel the timeout
+
+        Does nothing if the timeout already fired or was already cancelled
+        """
+        self.module._cancel_timeout(self)
+
+    def active(self):
+        """
+        Returns whether the timeout is still pending
+        """
+        return self in self.module._timeouts
+
+    def __str__(self):
+        return ("<Timeout {} deadline={}, interval={}, slack={}>"
+            .format(self.module.name, self.deadline, self.interval, self.slack)
+        )
+    def __repr__(self):
+        return str(self)
+
+def aligned_deadline(secs, now, fired = False):
+    """
+    Returns the perf_counter() time of the next wall clock multiple of secs
+
+    now is the current perf_counter() time. If fired, the deadline is at
+    least half a period away, so an interval that fired just before a
+    boundary (perf_counter() and the wall clock drift apart) does not fire
+    twice
+    """
+    wait = secs - time() % secs
+    if fired and wait < secs / 2:
+        wait += secs
+    return now + wait
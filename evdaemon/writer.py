@@ -0,0 +1,113 @@
+from os import set_blocking, write
+
+class Writer(object):
+    """
+    A buffered non-blocking writer for a file of a module
+
+    Data is written immediately as far as the file accepts it, the rest is
+    buffered and flushed when the daemon reports the file writable. The file
+    is made non-blocking
+
+    When the buffer grows past high_water bytes, (*path, "full") is emitted
+    privately to the module, and (*path, "drained") once the buffer is
+    empty again. Write errors emit (*path, "error", exception) and drop the
+    buffer
+
+    Attributes:
+    - module: the module the file is registered to
+    - file: a file descriptor or an object with a fileno() method
+    - high_water: the buffer size in bytes that signals backpressure
+    """
+    def __init__(self, module, file, *path, high_water = 65536):
+        self.module = module
+        self.file = file
+        self.path = path
+        self.high_water = high_water
+
+        self._fd = file if type(file) == int else file.fileno()
+        self._buf = bytearray()
+        self._full = False
+        self._closed = False
+        if hasattr(file, "setblocking"):
+            file.setblocking(False)
+        else:
+            set_blocking(self._fd, False)
+        module.listen_private("writer", self._fd, self._writable)
+
+    def write(self, data):
+        """
+        Write or buffer data
+
+        Returns False if the buffer is above high_water
+        """
+        if self._closed:
+            raise ValueError("writer is closed")
+        if len(self._buf) == 0:
+            data = memoryview(data)
+            n = self._write(data)
+            if n == len(data):
+                return True
+            self._buf += data[n:]
+            if not self._closed:
+                self.module.register_writable(self.file, "writer", self._fd)
+        else:
+            self._buf += data
+        if len(self._buf) > self.high_water and not self._full:
+            self._full = True
+            self.module.emit_private(*self.path, "full")
+        return not self._full
+
+    def full(self):
+        """
+        Returns whether the buffer is above high_water
+        """
+        return self._full
+
+    def pending(self):
+        """
+        Returns the number of buffered bytes
+        """
+        return len(self._buf)
+
+    def close(self):
+        """
+        Stop writing and drop the buffer
+
+        The file itself is not closed
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if len(self._buf) != 0:
+            self.module.unregister_writable(self.file)
+        self._buf = bytearray()
+        self.module.remove_private("writer", self._fd, self._writable)
+
+    # private API
+
+    def _write(self, data):
+        try:
+            return write(self._fd, data)
+        except BlockingIOError:
+            return 0
+        except OSError as e:
+            buffered = len(self._buf) != 0
+            self._buf = bytearray()
+            if buffered:
+                self.module.unregister_writable(self.file)
+            self._closed = True
+            self.module.remove_private("writer", self._fd, self._writable)
+            self.module.emit_private(*self.path, "error", e)
+            return len(data)
+
+    def _writable(self):
+        with memoryview(self._buf) as view:
+            n = self._write(view)
+        if self._closed:
+            return
+        del self._buf[:n]
+        if len(self._buf) == 0:
+            self.module.unregister_writable(self.file)
+            if self._full:
+                self._full = False
+                self.module.emit_private(*self.path, "drained")
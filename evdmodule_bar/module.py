@@ -0,0 +1,172 @@
+import json
+import sys
+from os import read, set_blocking
+from time import perf_counter
+
+from evdaemon import Module, Writer
+
+class barModule(Module):
+    """
+    An evd module that writes the i3bar/swaybar protocol
+
+    Other modules set blocks by name with set_block() or by emitting
+    ("bar", "set", name, block) and remove them with remove_block() or
+    ("bar", "remove", name). Blocks are dicts of i3bar block fields, their
+    "name" is set to the block name
+
+    The JSON of each block is cached and only re-encoded when the block
+    changed. Changes mark the bar dirty, a dirty bar is written once at the
+    end of the loop iteration, but at most once per interval seconds. While
+    the output is backed up, frames are skipped until it drained
+
+    With click_events, click events are read from stdin and emitted as
+    ("bar", "click", name, event)
+
+    The output (and the input with click_events) is made non-blocking, so
+    other output must not go to stdout. When the bar closes the output, the
+    module stops rendering
+
+    State:
+    - frames: the number of frames written
+    """
+    name = "bar"
+
+    def __init__(self, order = [], interval = 0, click_events = True, output = 1, input = 0):
+        super().__init__()
+        self.order = list(order)
+        self.interval = interval
+        self.click_events = click_events
+        self.state.frames = 0
+
+        self._blocks = {}
+        self._encoded = {}
+        self._dirty = False
+        self._scheduled = None
+        self._last_frame = None
+        self._input = input
+        self._input_buf = b""
+        self._closed = False
+        self._writer = Writer(self, output, "output")
+
+        self.listen("bar", "set", lambda name, block: self.set_block(name, block))
+        self.listen("bar", "remove", lambda name: self.remove_block(name))
+        self.listen_private("output", "drained", self._drained)
+        self.listen_private("output", "error", self._output_error)
+        self.listen_private("input", self._input_ready)
+
+        header = {"version": 1, "click_events": click_events}
+        self._writer.write((json.dumps(header) + "\n[\n").encode())
+        if click_events:
+            set_blocking(input, False)
+            self.register_file(input, "input")
+
+    def register_daemon(self, daemon):
+        super().register_daemon(daemon)
+        if self._dirty:
+            self._schedule()
+
+    def unregister_daemon(self, daemon):
+        super().unregister_daemon(daemon)
+        if self._scheduled != None:
+            self._scheduled.cancel()
+            self._scheduled = None
+
+    def set_block(self, name, block):
+        """
+        Set the block of a name
+
+        Does nothing if the block did not change
+        """
+        block = dict(block, name = name)
+        if self._blocks.get(name) == block:
+            return
+        self._blocks[name] = block
+        self._encoded[name] = json.dumps(block, separators = (",", ":"))
+        self._invalidate()
+
+    def remove_block(self, name):
+        """
+        Remove the block of a name
+        """
+        if name in self._blocks:
+            del self._blocks[name]
+            del self._encoded[name]
+            self._invalidate()
+
+    def blocks(self):
+        """
+        Returns the block names in display order
+        """
+        names = [name for name in self.order if name in self._blocks]
+        names += [name for name in self._blocks if name not in self.order]
+        return names
+
+    # private API
+
+    def _invalidate(self):
+        if self._dirty:
+            return
+        self._dirty = True
+        if self._daemon == None:
+            return
+        self._schedule()
+
+    def _schedule(self):
+        """
+        render at the end of this iteration, or when the interval is over
+        """
+        if self._scheduled != None or self._closed:
+            return
+        wait = 0
+        if self._last_frame != None:
+            wait = self._last_frame + self.interval - perf_counter()
+        if wait > 0:
+            self._scheduled = self.timeout(wait, lambda late: self._render())
+        else:
+            self.defer(self._render)
+
+    def _render(self):
+        self._scheduled = None
+        if not self._dirty or self._closed or self._writer.full():
+            return
+        self._dirty = False
+        self._last_frame = perf_counter()
+        frame = "[" + ",".join(self._encoded[name] for name in self.blocks()) + "],\n"
+        self._writer.write(frame.encode())
+        self.state.frames += 1
+
+    def _drained(self):
+        if self._dirty:
+            self._schedule()
+
+    def _output_error(self, error):
+        """
+        the bar closed the output, the writer is closed and frames are lost
+        """
+        print("[WARN][bar]", "output:", error, file = sys.stderr)
+        self._closed = True
+        if self._scheduled != None:
+            self._scheduled.cancel()
+            self._scheduled = None
+
+    def _input_ready(self):
+        """
+        read click events from the bar
+
+        the input is an endless JSON array with one event per line
+        """
+        try:
+            data = read(self._input, 65536)
+        except BlockingIOError:
+            return
+        if data == b"":
+            self.unregister_file(self._input)
+            return
+        lines = (self._input_buf + data).split(b"\n")
+        self._input_buf = lines.pop()
+        for line in lines:
+            line = line.strip().lstrip(b",")
+            if line == b"" or line == b"[":
+                continue
+            event = json.loads(line.decode())
+            self.emit(self.name, "click", event.get("name"), event)
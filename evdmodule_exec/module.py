@@ -0,0 +1,213 @@
+from collections import deque
+from os import read, set_blocking
+from subprocess import Popen, PIPE, DEVNULL
+from time import perf_counter
+
+from evdaemon import Module
+
+class Command(object):
+    """
+    A command run by an execModule
+
+    Returned by execModule.run(). Runs of the same name and command that
+    overlap share one Command
+
+    Attributes:
+    - name: the name the command was run with
+    - cmd: the command (an argument list, or a shell command string)
+    - returncode: the exit status, None while the command runs
+    - lines: a list of (stream, line) tuples in the order they arrived, only
+      kept with a ttl (the cached result is replayed from them)
+    - error: the exception raised when starting the process failed, or None
+    """
+    def __init__(self, name, cmd, ttl = 0):
+        self.name = name
+        self.cmd = cmd
+        self.returncode = None
+        self.lines = []
+        self.error = None
+        self._ttl = ttl
+        self._proc = None
+        self._pipes = {}
+
+    def started(self):
+        """
+        Returns whether the process was started (it may wait for a free slot)
+        """
+        return self._proc != None
+
+    def done(self):
+        """
+        Returns whether the command exited
+        """
+        return self.returncode != None
+
+    def kill(self):
+        """
+        Kill the process if it is running
+        """
+        if self._proc != None and self.returncode == None:
+            self._proc.kill()
+
+    def __str__(self):
+        return "<Command {} {!r} returncode={}>".format(self.name, self.cmd, self.returncode)
+    def __repr__(self):
+        return str(self)
+
+class execModule(Module):
+    """
+    An evd module that runs external commands without blocking the daemon
+
+    The stdout and stderr pipes of started processes are registered with
+    the daemon. Every complete line is emitted as
+    ("exec", "stdout" | "stderr", name, line) as soon as it arrives, and
+    ("exec", "exit", name, returncode) when the process exited. If the
+    process cannot be started, ("exec", "error", name, exception) is emitted
+
+    At most max_procs processes run at a time, further runs wait for a free
+    slot. A run of a command that is already running or waiting does not
+    start another process. With a ttl, the lines and exit status of a
+    command are cached and replayed for runs within ttl seconds
+
+    State:
+    - running: the number of running processes
+    - queued: the number of runs waiting for a free slot
+    """
+    name = "exec"
+
+    def __init__(self, max_procs = 4, ttl = 0):
+        super().__init__()
+        self.max_procs = max_procs
+        self.ttl = ttl
+        self.state.running = 0
+        self.state.queued = 0
+
+        self._commands = {}
+        self._queue = deque()
+        self._cache = {}
+        self.listen_private("pipe", self._pipe_ready)
+
+    def unregister_daemon(self, daemon):
+        super().unregister_daemon(daemon)
+        for command in self._commands.values():
+            command.kill()
+
+    def run(self, name, cmd, ttl = None):
+        """
+        Run a command
+
+        cmd is an argument list, or a string run by the shell. ttl overrides
+        the ttl of the module for this run. Returns a Command
+        """
+        if type(cmd) == list:
+            cmd = tuple(cmd)
+        key = (name, cmd)
+        command = self._commands.get(key)
+        if command != None:
+            return command
+
+        ttl = self.ttl if ttl == None else ttl
+        cached = self._cache.get(key)
+        if cached != None and cached[0] > perf_counter() and ttl > 0:
+            command = cached[1]
+            self.timeout(0, lambda late: self._replay(command))
+            return command
+
+        command = Command(name, cmd, ttl)
+        self._commands[key] = command
+        if self.state.running < self.max_procs:
+            self._start(command)
+        else:
+            self._queue.append(command)
+            self.state.queued = len(self._queue)
+        return command
+
+    def invalidate(self, name = None):
+        """
+        Drop cached results, only those of name if given
+        """
+        if name == None:
+            self._cache.clear()
+        else:
+            for key in [key for key in self._cache if key[0] == name]:
+                del self._cache[key]
+
+    # private API
+
+    def _start(self, command):
+        cmd = command.cmd
+        shell = type(cmd) == str
+        try:
+            command._proc = Popen(cmd if shell else list(cmd), shell = shell, stdin = DEVNULL, stdout = PIPE, stderr = PIPE)
+        except OSError as e:
+            # the slot stays free, the error is emitted outside of run()
+            command.error = e
+            del self._commands[(command.name, command.cmd)]
+            self.timeout(0, lambda late: self.emit(self.name, "error", command.name, command.error))
+            return
+        self.state.running += 1
+        for stream, pipe in (("stdout", command._proc.stdout), ("stderr", command._proc.stderr)):
+            set_blocking(pipe.fileno(), False)
+            command._pipes[pipe] = b""
+            self.register_file(pipe, "pipe", command, stream, pipe)
+
+    def _pipe_ready(self, command, stream, pipe):
+        """
+        read the available output of a pipe
+
+        emits complete lines, the last partial line is emitted at the end of
+        the stream
+        """
+        try:
+            data = read(pipe.fileno(), 65536)
+        except BlockingIOError:
+            return
+        buf = command._pipes[pipe] + data
+        lines = buf.split(b"\n")
+        if data == b"":
+            self.unregister_file(pipe)
+            pipe.close()
+            del command._pipes[pipe]
+            if lines[-1] == b"":
+                lines.pop()
+        else:
+            command._pipes[pipe] = lines.pop()
+
+        for line in lines:
+            line = line.decode(errors = "replace")
+            if command._ttl > 0:
+                command.lines.append((stream, line))
+            self.emit(self.name, stream, command.name, line)
+
+        if len(command._pipes) == 0:
+            self._wait(command)
+
+    def _wait(self, command):
+        """
+        wait for a process that closed its pipes to exit without blocking
+        """
+        if command._proc.poll() == None:
+            self.timeout(0.01, lambda late: self._wait(command))
+            return
+
+        command.returncode = command._proc.returncode
+        key = (command.name, command.cmd)
+        del self._commands[key]
+        if command._ttl > 0:
+            self._cache[key] = (perf_counter() + command._ttl, command)
+        self.state.running -= 1
+        self._start_queued()
+        self.emit(self.name, "exit", command.name, command.returncode)
+
+    def _start_queued(self):
+        """
+        start waiting commands while there are free slots
+        """
+        while len(self._queue) != 0 and self.state.running < self.max_procs:
+            self._start(self._queue.popleft())
+            self.state.queued = len(self._queue)
+
+    def _replay(self, command):
+        for stream, line in command.lines:
+            self.emit(self.name, stream, command.name, line)
+        self.emit(self.name, "exit", command.name, command.returncode)
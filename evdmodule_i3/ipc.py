@@ -1,11 +1,17 @@
-from socket import socket, AF_UNIX
+from asyncio import get_event_loop
+from collections import deque
+from os import environ
+from os.path import basename
+from socket import socket, AF_UNIX, MSG_DONTWAIT
 from subprocess import Popen, PIPE, DEVNULL
+from time import perf_counter
 import struct
 import json
 
-from evdaemon import Module
+from evdaemon import Module, Writer
 
 MAGIC = b"i3-ipc"
+HEADER = struct.Struct("=6sII")
 IS_EVENT = 1 << 31
 
 MSG = {
@@ -34,6 +40,13 @@ REPLY = {
     "config": 9
 }
 
+REPLY_NAMES = {value: name for name, value in REPLY.items()}
+
+SOCKET_ENV = {
+    "i3": ["I3SOCK", "SWAYSOCK"],
+    "sway": ["SWAYSOCK", "I3SOCK"]
+}
+
 EVENT = {
     "workspace": IS_EVENT | 0,
     "output": IS_EVENT | 1,
@@ -44,84 +57,520 @@ EVENT = {
     "shutdown": IS_EVENT | 6
 }
 
+EVENT_NAMES = {value: name for name, value in EVENT.items()}
+
+class Request(object):
+    """
+    A request sent to the i3 ipc
+
+    Returned by i3ipcModule.send_cmd(). Resolves with the reply to this
+    request only, callbacks are called with the decoded reply payload. Can be
+    awaited when the daemon runs on asyncio
+
+    The reply is kept, callbacks added after it arrived are called right
+    away. A reply nobody waited for is only decoded when result() is called
+
+    When the connection is lost before the reply arrived, the request fails:
+    callbacks are not called, result() and await raise the exception
+
+    Attributes:
+    - cmd: the message type of the request
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._done = False
+        self._callbacks = []
+        self._result = None
+        self._error = None
+        self._raw = None
+        self._decode = None
+        self._futures = []
+
+    def done(self):
+        """
+        Returns whether the reply to this request arrived
+        """
+        return self._done
+
+    def result(self):
+        """
+        Returns the reply payload
+
+        Raises ValueError if the reply did not arrive yet, or the exception
+        the request failed with
+        """
+        if not self._done:
+            raise ValueError("request not done")
+        if self._error != None:
+            raise self._error
+        if self._raw != None:
+            self._result = self._decode(self._raw)
+            self._raw = None
+            self._decode = None
+        return self._result
+
+    def exception(self):
+        """
+        Returns the exception the request failed with, or None
+        """
+        return self._error
+
+    def add_done_callback(self, fn):
+        """
+        Call fn with the reply payload when it arrives
+
+        fn is called immediately if the reply already arrived, and never if
+        the request failed
+        """
+        if self._done:
+            if self._error == None:
+                fn(self.result())
+            return
+        self._callbacks.append(fn)
+
+    def __await__(self):
+        if self._done:
+            return self.result()
+        future = get_event_loop().create_future()
+        self._futures.append(future)
+        return (yield from future)
+
+    def __str__(self):
+        return "<Request {} done={}>".format(self.cmd, self._done)
+    def __repr__(self):
+        return str(self)
+
+    def _wanted(self):
+        return len(self._callbacks) != 0 or len(self._futures) != 0
+
+    def _keep(self, raw, decode):
+        """
+        store a reply nobody waits for yet without decoding it
+        """
+        self._done = True
+        self._raw = raw
+        self._decode = decode
+
+    def _resolve(self, payload):
+        self._done = True
+        self._result = payload
+        callbacks = self._callbacks
+        self._callbacks = []
+        for future in self._wake():
+            future.set_result(payload)
+        for fn in callbacks:
+            fn(payload)
+
+    def _fail(self, error):
+        self._done = True
+        self._error = error
+        self._callbacks = []
+        for future in self._wake():
+            future.set_exception(error)
+
+    def _wake(self):
+        futures = self._futures
+        self._futures = []
+        return [future for future in futures if not future.done()]
+
+class LazyPayload(object):
+    """
+    A JSON message payload that is only decoded when it is first accessed
+
+    Supports the read-only operations of the decoded object (a dict or a
+    list), value() returns the decoded object itself
+    """
+    __slots__ = ("_text", "_value")
+
+    def __init__(self, text):
+        self._text = text
+        self._value = None
+
+    def value(self):
+        """
+        Returns the decoded payload
+        """
+        if self._text != None:
+            self._value = json.loads(self._text)
+            self._text = None
+        return self._value
+
+    def get(self, key, default = None):
+        return self.value().get(key, default)
+
+    def keys(self):
+        return self.value().keys()
+
+    def values(self):
+        return self.value().values()
+
+    def items(self):
+        return self.value().items()
+
+    def __getitem__(self, key):
+        return self.value()[key]
+
+    def __contains__(self, key):
+        return key in self.value()
+
+    def __iter__(self):
+        return iter(self.value())
+
+    def __len__(self):
+        return len(self.value())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyPayload):
+            other = other.value()
+        return self.value() == other
+
+    __hash__ = None
+
+    def __str__(self):
+        return str(self.value())
+    def __repr__(self):
+        return "<LazyPayload {!r}>".format(self.value())
+
+class FrameDecoder(object):
+    """
+    An incremental decoder for i3 ipc frames
+
+    Data is received directly into a reusable buffer, complete frames are
+    decoded from that buffer and partial frames are kept until the rest
+    arrives. The buffer grows if a frame does not fit
+    """
+    def __init__(self, size = 65536):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def recv_from(self, sock):
+        """
+        Receive data that is available on a socket without blocking
+
+        Receives at most what fits into the buffer, so one busy socket
+        cannot hold up the daemon. The socket stays readable while more data
+        is available. Returns False if the remote end closed the connection
+        """
+        if self._end == len(self._buf):
+            self._make_room()
+        with memoryview(self._buf) as view:
+            try:
+                n = sock.recv_into(view[self._end:], 0, MSG_DONTWAIT)
+            except BlockingIOError:
+                return True
+            except ConnectionResetError:
+                return False
+        if n == 0:
+            return False
+        self._end += n
+        return True
+
+    def frames(self):
+        """
+        Yields (msg_type, payload) for every complete frame in the buffer
+
+        The payload is a memoryview into the receive buffer, it is only valid
+        until the next frame is requested
+        """
+        with memoryview(self._buf) as view:
+            while self._end - self._start >= HEADER.size:
+                magic, payload_len, msg_type = HEADER.unpack_from(view, self._start)
+                if magic != MAGIC:
+                    raise ValueError("remote i3 does not follow the protocol!")
+                payload_start = self._start + HEADER.size
+                payload_end = payload_start + payload_len
+                if payload_end > self._end:
+                    break
+                self._start = payload_end
+                with view[payload_start:payload_end] as payload:
+                    yield msg_type, payload
+        if self._start == self._end:
+            self._start = 0
+            self._end = 0
+
+    def _make_room(self):
+        if self._start != 0:
+            pending = self._end - self._start
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        else:
+            buf = bytearray(2 * len(self._buf))
+            buf[:self._end] = self._buf
+            self._buf = buf
+
+class Connection(object):
+    """
+    A connection to the i3 ipc
+
+    Replies arrive in the order the requests were sent on the same
+    connection, so every connection matches its replies separately. Write
+    errors are emitted privately as ("connection", conn, "error", exception)
+
+    Attributes:
+    - sock: the connected socket
+    - pending: the requests waiting for a reply, oldest first
+    """
+    def __init__(self, module, sock):
+        self.sock = sock
+        self.pending = deque()
+        self._writer = Writer(module, sock, "connection", self)
+        self._decoder = FrameDecoder()
+
+    def send(self, cmd, payload):
+        """
+        Send a message, returns a Request for its reply
+        """
+        request = Request(cmd)
+        self.pending.append(request)
+        self._writer.write(HEADER.pack(MAGIC, len(payload), MSG[cmd]) + payload)
+        return request
+
+    def recv(self):
+        """
+        Receive all available data, returns False if i3 closed the connection
+        """
+        return self._decoder.recv_from(self.sock)
+
+    def frames(self):
+        """
+        Yields (msg_type, payload) for every complete message received
+        """
+        return self._decoder.frames()
+
+    def close(self, error = None):
+        """
+        Close the socket and fail pending requests
+        """
+        self._writer.close()
+        self.sock.close()
+        if error == None:
+            error = ConnectionError("i3 ipc connection closed")
+        while len(self.pending) != 0:
+            self.pending.popleft()._fail(error)
+
+    def __str__(self):
+        return "<Connection fd={} pending={}>".format(self.sock.fileno(), len(self.pending))
+    def __repr__(self):
+        return str(self)
+
 class i3ipcModule(Module):
     """
     A low-level evd module responsible for sending messages to the i3 window manager
+
+    sock can be an already connected socket. Otherwise, the socket path is
+    the socketpath argument if given, then the I3SOCK and SWAYSOCK
+    environment variables are tried, and only then the window manager
+    binary is asked. Paths from the binary are cached per
+    binary in socketpath_cache
+
+    Subscriptions use a dedicated event connection that is opened with the
+    first subscribe message. Other messages are sent on command_connections
+    separate connections (the one with the fewest outstanding requests is
+    used), so replies do not wait behind event traffic. A given sock is used
+    for both
+
+    Messages are written through a Writer, so a slow window manager does not
+    block the daemon. When a connection is closed or cannot be written to,
+    all connections are closed, pending requests fail and ("i3ipc",
+    "disconnect") is emitted. Messages sent while disconnected fail right
+    away
+
+    Messages are only decoded if a listener or a request waits for them.
+    With lazy_payloads, payloads are passed as LazyPayload objects that are
+    only decoded when they are accessed
+
+    State:
+    - connected: whether the ipc socket is connected
+    - socketpath: the path of the connected socket
+    - timings: seconds spent in each phase of connecting
     """
     name = "i3ipc"
-    def __init__(self, socketpath_binary = "i3"):
+    socketpath_cache = {}
+
+    def __init__(self, socketpath_binary = "i3", socketpath = None, lazy_payloads = False, sock = None, command_connections = 1):
         super().__init__()
         self._socketbin = socketpath_binary
+        self._socketpath = socketpath
+        self._sock = sock
+        self._lazy = lazy_payloads
+        self._command_count = max(command_connections, 1)
+        self._event_conn = None
+        self._command_conns = []
+        self.listen_private("socket_ready", self._ready)
+        self.listen_private("connection", self._connection_event)
         self.state.connected = False
+        self.state.socketpath = None
+        self.state.timings = {}
         self._connect()
 
     def _get_socketpath(self):
+        start = perf_counter()
         i3 = Popen([self._socketbin, "--get-socketpath"], stdout = PIPE, stderr = DEVNULL)
         i3.wait()
         raw = i3.stdout.read()
         decoded = raw[:-1].decode()
+        self.state.timings["subprocess"] = perf_counter() - start
         return decoded
 
-    def _connect(self):
+    def _try_connect(self, sockpath):
+        sock = socket(AF_UNIX)
+        try:
+            sock.connect(sockpath)
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+    def _open_socket(self):
         """
-        connect to i3 ipc
+        find the ipc socket and connect to it
         """
-        sock = socket(AF_UNIX)
+        if self._socketpath != None:
+            sock = socket(AF_UNIX)
+            sock.connect(self._socketpath)
+            return sock, self._socketpath
+
+        env = SOCKET_ENV.get(basename(self._socketbin), SOCKET_ENV["i3"])
+        for name in env:
+            sockpath = environ.get(name)
+            if sockpath:
+                sock = self._try_connect(sockpath)
+                if sock != None:
+                    return sock, sockpath
+
+        sockpath = self.socketpath_cache.get(self._socketbin)
+        if sockpath != None:
+            sock = self._try_connect(sockpath)
+            if sock != None:
+                return sock, sockpath
+            del self.socketpath_cache[self._socketbin]
+
         sockpath = self._get_socketpath()
+        sock = socket(AF_UNIX)
         sock.connect(sockpath)
-        self.register_file(sock, "socket_ready")
-        self.listen_private("socket_ready", self._ready)
-        self._socket = sock
-        self.state.connected = True
+        self.socketpath_cache[self._socketbin] = sockpath
+        return sock, sockpath
 
-    def _ready(self):
+    def _connect(self):
         """
-        received a message from the ipc socket
+        connect to i3 ipc
         """
-        magic = self._socket.recv(len(MAGIC))
-        if magic == b"":
-            self._socket.close()
-            self.unregister_file(self._socket)
-            self.state.connected = False
-            self.emit(self.name, "disconnect")
-        elif magic != MAGIC:
-            raise ValueError("remote i3 does not follow the protocol!")
+        start = perf_counter()
+        if self._sock != None:
+            conn = self._add_connection(self._sock)
+            self._event_conn = conn
+            self._command_conns = [conn]
+            sockpath = None
         else:
-            payload_len = struct.unpack("I", self._socket.recv(4))[0]
-            msg_type = struct.unpack("I", self._socket.recv(4))[0]
-            payload = self._socket.recv(payload_len).decode()
-            self._decode_message(msg_type, payload)
+            sock, sockpath = self._open_socket()
+            self._command_conns = [self._add_connection(sock)]
+            for _ in range(1, self._command_count):
+                sock = socket(AF_UNIX)
+                sock.connect(sockpath)
+                self._command_conns.append(self._add_connection(sock))
+        self.state.timings["connect"] = perf_counter() - start
+        self.state.socketpath = sockpath
+        self.state.connected = True
+
+    def _add_connection(self, sock):
+        conn = Connection(self, sock)
+        self.register_file(sock, "socket_ready", conn)
+        return conn
+
+    def _event_connection(self):
+        """
+        the connection for subscriptions, opened on first use
+        """
+        if self._event_conn == None:
+            sock = socket(AF_UNIX)
+            sock.connect(self.state.socketpath)
+            self._event_conn = self._add_connection(sock)
+        return self._event_conn
+
+    def _ready(self, conn):
+        """
+        received data on an ipc socket
+
+        handles all complete messages that arrived
+        """
+        connected = conn.recv()
+        for msg_type, payload in conn.frames():
+            self._decode_message(conn, msg_type, payload)
+        if not connected and self.state.connected:
+            self._disconnect()
+
+    def _connection_event(self, conn, event, *args):
+        if event == "error" and self.state.connected:
+            self._disconnect(*args)
+
+    def _disconnect(self, error = None):
+        """
+        close all connections when one of them was closed by i3 or failed
+        """
+        conns = list(self._command_conns)
+        if self._event_conn != None and self._event_conn not in conns:
+            conns.append(self._event_conn)
+        for conn in conns:
+            self.unregister_file(conn.sock)
+            conn.close(error)
+        self._event_conn = None
+        self._command_conns = []
+        self.state.connected = False
+        self.emit(self.name, "disconnect")
 
-    def _decode_message(self, msg_type, payload):
+    def _decode_message(self, conn, msg_type, payload):
         """
         decode an i3 ipc message
+
+        replies are matched to requests in the order they were sent,
+        replies nobody waits for are kept undecoded in their request, events
+        nobody listens for are dropped
         """
-        payload = json.loads(payload)
-        path = [self.name]
         if msg_type & IS_EVENT == 0:
-            path.append("reply")
-            for name, value in REPLY.items():
-                if msg_type == value:
-                    path.append(name)
-                    break
-            if len(path) < 3:
-                path.append("unknown")
+            request = conn.pending.popleft() if len(conn.pending) != 0 else None
+            path = (self.name, "reply", REPLY_NAMES.get(msg_type, "unknown"))
         else:
-            path.append("event")
-            for name, value in EVENT.items():
-                if msg_type == value:
-                    path.append(name)
-                    break
-            if len(path) < 3:
-                path.append("unknown")
-        self.emit(*path, payload)
+            request = None
+            path = (self.name, "event", EVENT_NAMES.get(msg_type, "unknown"))
+
+        listening = self.has_listeners(*path)
+        if request != None and not request._wanted() and not listening:
+            request._keep(bytes(payload), self._decode_payload)
+            return
+        if not listening and request == None:
+            return
+
+        payload = self._decode_payload(payload)
+        if request != None:
+            request._resolve(payload)
+        if listening:
+            self.emit(*path, payload)
+
+    def _decode_payload(self, payload):
+        payload = str(payload, "utf-8")
+        if self._lazy:
+            return LazyPayload(payload)
+        return json.loads(payload)
 
     def send_cmd(self, cmd, payload = ""):
+        """
+        send a message to the i3 ipc
+
+        subscribe messages are sent on the event connection, all others on
+        the least busy command connection. Returns a Request that resolves
+        with the reply to this message
+        """
         if type(payload) != str:
             payload = json.dumps(payload)
-        self._socket.send(
-            MAGIC +
-            struct.pack("I", len(payload)) +
-            struct.pack("I", MSG[cmd]) +
-            payload.encode()
-        )
+        payload = payload.encode()
+        if not self.state.connected:
+            request = Request(cmd)
+            request._fail(ConnectionError("i3 ipc is not connected"))
+            return request
+        if cmd == "subscribe":
+            conn = self._event_connection()
+        else:
+            conn = min(self._command_conns, key = lambda conn: len(conn.pending))
+        return conn.send(cmd, payload)
@@ -1,19 +1,61 @@
 import sys
+from time import perf_counter
+from evdaemon.timeout import Timeout
 from evdmodule_wm import *
 
-from .ipc import i3ipcModule
+from .ipc import i3ipcModule, LazyPayload
+from .tree import Tree
 
 class i3Module(wmModule):
     """
     An evd window manager module for the i3 window manager
+
+    Workspace and output events trigger a refresh of the workspaces or
+    outputs. Refreshes are coalesced: while a query is in flight (or waiting
+    for refresh_delay seconds), further events are kept and applied to its
+    reply. The reply is always applied, events that cannot be applied to it
+    mark it dirty, and a dirty reply is followed by one more query
+
+    Workspace events are applied to the workspace state directly where the
+    event carries enough information, only the rest trigger a refresh
+
+    With track_tree, the container tree is queried once and mirrored in
+    tree. Window and workspace events update the mirror where they can
+    (close, title, focus, urgent, rename, empty), other changes refresh it.
+    Like workspace events, events during the tree query are applied to its
+    reply. The mirror fills state.windows and links windows, workspaces and monitors
+
+    Attributes:
+    - startup_times: seconds spent in each phase of registering to the daemon
+    - refresh_delay: seconds to wait before sending a refresh query
+    - tree: the mirrored container tree (None without track_tree)
     """
-    def __init__(self, events = ["workspace", "output", "mode", "window", "shutdown"], ipc = None):
+    def __init__(self, events = ["workspace", "output", "mode", "window", "shutdown"], ipc = None, refresh_delay = 0, track_tree = False):
         super().__init__()
         self.events = events
+        self.startup_times = {}
+        self.refresh_delay = refresh_delay
+        self.track_tree = track_tree
+        self.tree = None
 
-        self.listen("i3ipc", "reply", "workspaces", self._workspaces)
-        self.listen("i3ipc", "reply", "subscribe", self._subscribe)
-        self.listen("i3ipc", "reply", "outputs", self._outputs)
+        self._workspace_ids = {}
+        self._workspace_outputs = {}
+        self._refreshing = {}
+        self._refresh_dirty = set()
+        self._refresh_events = {}
+        self._linked_monitors = {}
+        self._linked_workspaces = {}
+        self._linked_outputs = {}
+        self._window_workspaces = {}
+        self._workspace_windows = {}
+        self._relink_windows = False
+        self._refresh_handlers = {
+            "workspaces": self._workspaces,
+            "outputs": self._outputs,
+            "tree": self._tree
+        }
+
+        self.listen("i3ipc", "disconnect", self._disconnect)
         self.listen("i3ipc", "event", "workspace", self._workspace_event)
         self.listen("i3ipc", "event", "output", self._output_event)
         self.listen("i3ipc", "event", "mode", self._mode_event)
@@ -23,18 +65,83 @@ class i3Module(wmModule):
     def register_daemon(self, daemon):
         super().register_daemon(daemon)
 
+        self.startup_times = {}
+        start = perf_counter()
+        phase_start = start
         if "i3ipc" not in daemon.modules:
             daemon.register(i3ipcModule())
 
         self._ipc = daemon.modules["i3ipc"]
-        self._ipc.send_cmd("outputs")
-        self._ipc.send_cmd("workspaces")
-        self._ipc.send_cmd("subscribe", self.events)
+        phase_start = self._startup_phase("ipc", phase_start)
+        self._send_refresh("outputs")
+        phase_start = self._startup_phase("outputs", phase_start)
+        self._send_refresh("workspaces")
+        phase_start = self._startup_phase("workspaces", phase_start)
+        if self.track_tree:
+            self._send_refresh("tree")
+            phase_start = self._startup_phase("tree", phase_start)
+        self._ipc.send_cmd("subscribe", self.events).add_done_callback(self._subscribe)
+        phase_start = self._startup_phase("subscribe", phase_start)
+        self.startup_times["total"] = phase_start - start
 
     def unregister_daemon(self, daemon):
-        super().unregister_daemon()
+        super().unregister_daemon(daemon)
         daemon.unregister(self._ipc)
 
+    def _startup_phase(self, phase, phase_start):
+        now = perf_counter()
+        self.startup_times[phase] = now - phase_start
+        return now
+
+    def _refresh(self, cmd):
+        if cmd in self._refreshing:
+            self._refresh_dirty.add(cmd)
+        elif self.refresh_delay > 0:
+            self._refreshing[cmd] = self.timeout(
+                self.refresh_delay,
+                lambda late: self._send_refresh(cmd)
+            )
+        else:
+            self._send_refresh(cmd)
+
+    def _send_refresh(self, cmd):
+        self._refresh_dirty.discard(cmd)
+        request = self._ipc.send_cmd(cmd)
+        if request.exception() != None:
+            # the ipc is disconnected, _disconnect() already ran
+            return
+        request.add_done_callback(lambda payload: self._refreshed(cmd, payload))
+        self._refreshing[cmd] = request
+
+    def _refreshed(self, cmd, payload):
+        del self._refreshing[cmd]
+        self._refresh_handlers[cmd](payload)
+        for delta, args in self._refresh_events.pop(cmd, ()):
+            if not delta(*args):
+                self._refresh_dirty.add(cmd)
+        if cmd in self._refresh_dirty:
+            self._refresh(cmd)
+
+    def _apply(self, cmd, delta, *args):
+        """
+        apply an event to the state that cmd queries
+
+        delta returns False if it cannot apply the event. While cmd is
+        refreshed, the event is kept and applied to the reply instead
+        """
+        if cmd in self._refreshing:
+            self._refresh_events.setdefault(cmd, []).append((delta, args))
+        elif not delta(*args):
+            self._refresh(cmd)
+
+    def _disconnect(self):
+        for cmd, pending in self._refreshing.items():
+            if isinstance(pending, Timeout):
+                pending.cancel()
+        self._refreshing.clear()
+        self._refresh_dirty.clear()
+        self._refresh_events.clear()
+
     def _construct_workspace(self, workspace):
         if workspace == None:
             return None
@@ -53,6 +160,17 @@ class i3Module(wmModule):
         ws.visible = workspace['visible']
         return ws
 
+    def _construct_window(self, node):
+        window = Window(node.get("window"))
+        self._update_window(window, node)
+        return window
+
+    def _update_window(self, window, node):
+        window.title = node["name"]
+        window.focused = node["focused"]
+        window.urgent = node["urgent"]
+        window.floating = node.get("floating", "").endswith("_on") or node["type"] == "floating_con"
+
     def _construct_monitor(self, output):
         if output == None:
             return None
@@ -67,17 +185,260 @@ class i3Module(wmModule):
 
     def _workspaces(self, payload):
         workspaces = dict()
+        self._workspace_ids = {}
+        self._workspace_outputs = {}
         for workspace in payload:
             ws = self._construct_workspace(workspace)
-            workspaces[(ws.num, ws.name)] = ws
+            key = (ws.num, ws.name)
+            workspaces[key] = ws
+            if "id" in workspace:
+                self._workspace_ids[workspace["id"]] = key
+            self._workspace_outputs[key] = workspace["output"]
+
+        self.update_workspaces(workspaces)
+
+    def _workspace_delta(self, payload):
+        """
+        apply a workspace event to the workspace state
 
+        returns False if the event does not carry enough information and the
+        workspaces have to be queried
+        """
+        change = payload["change"]
+        current = payload["current"]
+        if current == None:
+            return False
+        key = self._workspace_ids.get(current["id"])
+        workspaces = dict(self.state.workspaces)
+
+        if change == "init":
+            if key != None:
+                # already known, e.g. from the reply the event is replayed on
+                return True
+            if "output" not in current:
+                return False
+            ws = self._construct_workspace(dict(current, visible = current["focused"]))
+            key = (ws.num, ws.name)
+            workspaces[key] = ws
+            self._workspace_ids[current["id"]] = key
+            self._workspace_outputs[key] = current["output"]
+        elif change == "empty" and key == None:
+            # already gone
+            return True
+        elif key == None:
+            return False
+        elif change == "empty":
+            del workspaces[key]
+            del self._workspace_ids[current["id"]]
+            del self._workspace_outputs[key]
+        elif change == "focus":
+            output = self._workspace_outputs[key]
+            for other, ws in workspaces.items():
+                focused = other == key
+                visible = focused or (ws.visible and self._workspace_outputs[other] != output)
+                if ws.focused != focused or ws.visible != visible:
+                    ws = ws.copy()
+                    ws.focused = focused
+                    ws.visible = visible
+                    workspaces[other] = ws
+        elif change == "urgent":
+            ws = workspaces[key].copy()
+            ws.urgent = current["urgent"]
+            workspaces[key] = ws
+        elif change == "rename":
+            old = workspaces.pop(key)
+            ws = self._construct_workspace(dict(current, focused = old.focused, visible = old.visible))
+            ws.urgent = old.urgent
+            new_key = (ws.num, ws.name)
+            workspaces[new_key] = ws
+            self._workspace_ids[current["id"]] = new_key
+            self._workspace_outputs[new_key] = self._workspace_outputs.pop(key)
+        elif change == "move":
+            if "output" not in current:
+                return False
+            output = current["output"]
+            old_output = self._workspace_outputs[key]
+            if output == old_output:
+                return True
+            moved = workspaces[key]
+            remaining = [other for other in workspaces if other != key and self._workspace_outputs[other] == old_output]
+            if moved.visible and len(remaining) > 1:
+                # i3 shows one of them instead, but the event does not say which
+                return False
+            self._workspace_outputs[key] = output
+            for other, ws in workspaces.items():
+                if other == key:
+                    visible = ws.visible
+                elif self._workspace_outputs[other] == output:
+                    visible = ws.visible and not moved.visible
+                elif other in remaining:
+                    visible = ws.visible or moved.visible
+                else:
+                    continue
+                if ws.visible != visible or other == key:
+                    ws = ws.copy()
+                    ws.visible = visible
+                    workspaces[other] = ws
+            if "rect" in current:
+                rect = current["rect"]
+                workspaces[key].rect = Rect(rect["x"], rect["y"], rect["width"], rect["height"])
+        else:
+            return False
+
+        self.update_workspaces(workspaces)
+        return True
+
+    def _tree(self, payload):
+        if isinstance(payload, LazyPayload):
+            payload = payload.value()
+        self.tree = Tree(payload)
+        self._relink_windows = True
+        windows = dict()
+        for node in self.tree.client_windows():
+            windows[node["id"]] = self._construct_window(node)
+
+        self.update_windows(windows)
+
+    def _link(self, collection, added, removed, changed):
+        """
+        link monitors, workspaces and windows to each other
+
+        only entries that changed are relinked. Objects that are already in
+        the state may be shared with snapshots, they are replaced by linked
+        copies instead of being modified
+        """
+        windows = self.state.windows
+        workspaces = dict(self.state.workspaces)
+        monitors = dict(self.state.monitors)
+        linked_windows = []
+        dirty_ws_ids = set()
+
+        if collection == "windows" and self.tree != None:
+            if self._relink_windows:
+                self._relink_windows = False
+                self._window_workspaces = {}
+                self._workspace_windows = {}
+                added = list(windows)
+                changed = ()
+            for con_id in removed:
+                ws_id = self._window_workspaces.pop(con_id, None)
+                if ws_id != None:
+                    self._workspace_windows[ws_id].remove(con_id)
+                    dirty_ws_ids.add(ws_id)
+            for keys in (added, changed):
+                for con_id in keys:
+                    node = self.tree.workspace(con_id)
+                    ws_id = node["id"] if node != None else None
+                    old_ws_id = self._window_workspaces.get(con_id)
+                    if old_ws_id != ws_id:
+                        if old_ws_id != None:
+                            self._workspace_windows[old_ws_id].remove(con_id)
+                            dirty_ws_ids.add(old_ws_id)
+                        if ws_id != None:
+                            self._workspace_windows.setdefault(ws_id, []).append(con_id)
+                            self._window_workspaces[con_id] = ws_id
+                        else:
+                            del self._window_workspaces[con_id]
+                    dirty_ws_ids.add(ws_id)
+                    linked_windows.append((windows[con_id], ws_id))
+
+        # workspaces that were replaced or whose windows changed
+        dirty_ws = set(key for key, ws in workspaces.items() if self._linked_workspaces.get(key) is not ws)
+        for ws_id in dirty_ws_ids:
+            key = self._workspace_ids.get(ws_id)
+            if key in workspaces:
+                dirty_ws.add(key)
+        dirty_monitors = set(name for name, monitor in monitors.items() if self._linked_monitors.get(name) is not monitor)
+        for key, ws in self._linked_workspaces.items():
+            if key not in workspaces or key in dirty_ws:
+                dirty_monitors.add(self._linked_outputs.get(key))
+        for key in dirty_ws:
+            dirty_monitors.add(self._workspace_outputs.get(key))
+
+        ws_ids = {key: ws_id for ws_id, key in self._workspace_ids.items()}
+        for key in dirty_ws:
+            ws = workspaces[key]
+            if ws is self._linked_workspaces.get(key):
+                ws = ws.copy()
+                workspaces[key] = ws
+            if self.tree != None:
+                con_ids = self._workspace_windows.get(ws_ids.get(key), ())
+                ws.windows = [windows[con_id] for con_id in con_ids if con_id in windows]
+            else:
+                ws.windows = []
+        for name in dirty_monitors:
+            monitor = monitors.get(name)
+            if monitor == None:
+                continue
+            if monitor is self._linked_monitors.get(name):
+                monitor = monitor.copy()
+                monitors[name] = monitor
+            monitor.workspaces = [ws for key, ws in workspaces.items() if self._workspace_outputs.get(key) == name]
+        for key in dirty_ws:
+            workspaces[key].monitor = monitors.get(self._workspace_outputs.get(key))
+        for window, ws_id in linked_windows:
+            window.workspace = workspaces.get(self._workspace_ids.get(ws_id))
+
+        self._linked_workspaces = workspaces
+        self._linked_monitors = monitors
+        self._linked_outputs = dict(self._workspace_outputs)
+        self.state.monitors = monitors
         self.state.workspaces = workspaces
-        self.emit("wm", "workspaces")
+
+    def _tree_window_delta(self, change, container):
+        """
+        apply a window event to the tree mirror
+
+        returns False if the tree has to be queried
+        """
+        if self.tree == None:
+            return False
+        elif change == "close":
+            if self.tree.remove(container["id"]):
+                windows = dict(self.state.windows)
+                windows.pop(container["id"], None)
+                self.update_windows(windows)
+        elif change in ("title", "focus", "urgent", "mark", "fullscreen_mode"):
+            # changed windows are replaced by copies, the old objects may be
+            # shared with snapshots
+            windows = dict(self.state.windows)
+            if change == "focus":
+                for con_id, window in windows.items():
+                    if window.focused and con_id != container["id"]:
+                        window = window.copy()
+                        window.focused = False
+                        windows[con_id] = window
+                        self.tree.nodes[con_id]["focused"] = False
+            if not self.tree.update(container):
+                return False
+            if container["id"] in windows:
+                window = windows[container["id"]].copy()
+                self._update_window(window, self.tree.nodes[container["id"]])
+                windows[container["id"]] = window
+            self.update_windows(windows)
+        else:
+            return False
+        return True
+
+    def _tree_workspace_delta(self, change, current):
+        """
+        apply a workspace event to the tree mirror
+
+        returns False if the tree has to be queried
+        """
+        if self.tree == None or current == None:
+            return False
+        elif change == "empty":
+            self.tree.remove(current["id"])
+        elif change in ("focus", "urgent", "rename"):
+            return self.tree.update(current)
+        else:
+            return False
+        return True
 
     def _subscribe(self, payload):
         if "success" not in payload or not payload["success"]:
-            print(payload)
-            print("[WARN][i3]", "subscribe:", "failed!", file = sys.stderr)
+            print("[WARN][i3]", "subscribe:", "failed!", payload, file = sys.stderr)
 
     def _outputs(self, payload):
         monitors = dict()
@@ -85,11 +446,12 @@ class i3Module(wmModule):
             monitor = self._construct_monitor(output)
             monitors[monitor.name] = monitor
 
-        self.state.monitors = monitors
-        self.emit("wm", "monitors")
+        self.update_monitors(monitors)
 
     def _workspace_event(self, payload):
-        self._ipc.send_cmd("workspaces")
+        if self.track_tree:
+            self._apply("tree", self._tree_workspace_delta, payload["change"], payload["current"])
+        self._apply("workspaces", self._workspace_delta, payload)
 
         if payload["change"] == "focus":
             cur = payload["current"]
@@ -101,7 +463,7 @@ class i3Module(wmModule):
         if "change" not in payload or payload["change"] != "unspecified":
             print("[WARN][i3]", "output event:", "contains unknown change:", payload["change"], file = sys.stderr)
 
-        self._ipc.send_cmd("outputs")
+        self._refresh("outputs")
 
     def _mode_event(self, payload):
         self.state.mode = payload["change"]
@@ -111,6 +473,8 @@ class i3Module(wmModule):
 
     def _window_event(self, payload):
         container = payload["container"]
+        if self.track_tree:
+            self._apply("tree", self._tree_window_delta, payload["change"], container)
 
         if payload["change"] == "focus" or (payload["change"] == "title" and container["focused"]):
             self.state.title = container["name"]
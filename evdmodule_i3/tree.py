@@ -0,0 +1,104 @@
+class Tree(object):
+    """
+    An in-memory mirror of the i3 container tree
+
+    Built from a tree reply, nodes are the container objects of the reply.
+    Containers can be looked up by their con id and by their X window id
+
+    Attributes:
+    - root: the root container
+    - nodes: a dict of con ids to containers
+    - windows: a dict of X window ids to containers
+    """
+    def __init__(self, root):
+        self.root = root
+        self.nodes = {}
+        self.windows = {}
+        self._parents = {}
+        self._index(root, None)
+
+    def parent(self, con_id):
+        """
+        Returns the parent container of a container, or None
+        """
+        parent_id = self._parents.get(con_id)
+        if parent_id == None:
+            return None
+        return self.nodes[parent_id]
+
+    def workspace(self, con_id):
+        """
+        Returns the workspace container a container is on, or None
+        """
+        node = self.nodes.get(con_id)
+        while node != None and node["type"] != "workspace":
+            node = self.parent(node["id"])
+        return node
+
+    def client_windows(self):
+        """
+        Yields all containers that hold a client window
+        """
+        for node in self.nodes.values():
+            if is_window(node):
+                yield node
+
+    def update(self, con):
+        """
+        Updates the fields of a container from an event container
+
+        Children are kept. Returns False if the container is unknown
+        """
+        node = self.nodes.get(con["id"])
+        if node == None:
+            return False
+        if node.get("window") != None:
+            del self.windows[node["window"]]
+        for name, value in con.items():
+            if name != "nodes" and name != "floating_nodes":
+                node[name] = value
+        if node.get("window") != None:
+            self.windows[node["window"]] = node
+        return True
+
+    def remove(self, con_id):
+        """
+        Removes a container and its children
+
+        Returns False if the container is unknown
+        """
+        node = self.nodes.get(con_id)
+        if node == None:
+            return False
+        parent = self.parent(con_id)
+        if parent != None:
+            for children in (parent["nodes"], parent["floating_nodes"]):
+                if node in children:
+                    children.remove(node)
+        self._unindex(node)
+        return True
+
+    # private API
+
+    def _index(self, node, parent):
+        self.nodes[node["id"]] = node
+        if parent != None:
+            self._parents[node["id"]] = parent["id"]
+        if node.get("window") != None:
+            self.windows[node["window"]] = node
+        for child in node["nodes"] + node["floating_nodes"]:
+            self._index(child, node)
+
+    def _unindex(self, node):
+        del self.nodes[node["id"]]
+        self._parents.pop(node["id"], None)
+        if node.get("window") != None:
+            self.windows.pop(node["window"], None)
+        for child in node["nodes"] + node["floating_nodes"]:
+            self._unindex(child)
+
+def is_window(node):
+    """
+    Returns whether a container holds a client window (X11 or wayland)
+    """
+    return node.get("window") != None or node.get("app_id") != None
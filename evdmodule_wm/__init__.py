@@ -1,3 +1,4 @@
+from .diff import diff
 from .rect import Rect
 from .window import Window
 from .workspace import Workspace
@@ -0,0 +1,33 @@
+from itertools import compress
+from operator import is_not
+
+def field_diff(a, b):
+    """
+    Returns the names of the fields that differ between two wm objects
+    """
+    return tuple(
+        name for name in a.fields
+            if getattr(a, name) != getattr(b, name)
+    )
+
+def diff(old, new):
+    """
+    Compares two dicts of wm objects
+
+    Returns (added, removed, changed), where added and removed are lists of
+    keys and changed is a dict of keys to the names of the changed fields
+    """
+    if old.keys() == new.keys():
+        added = []
+        removed = []
+    else:
+        added = [key for key in new if key not in old]
+        removed = [key for key in old if key not in new]
+    changed = {}
+    # only entries that were replaced are compared field by field
+    for key in compress(new, map(is_not, new.values(), map(old.get, new))):
+        if key in old:
+            fields = field_diff(old[key], new[key])
+            if len(fields) != 0:
+                changed[key] = fields
+    return added, removed, changed
@@ -1,12 +1,19 @@
 from evdaemon import Module
 
+from .diff import diff
+
 class wmModule(Module):
     """
     Represents a Window Manager and its state
 
+    The update_*() methods replace a collection in the state and emit events
+    for the entries that were added, removed or changed
+
     State:
     - monitors: a dict of Monitor objects
     - workspaces: a dict of Workspace objects
+    - windows: a dict of Window objects (only if the window manager module
+      tracks windows)
     """
     name = "wm"
     def __init__(self):
@@ -15,3 +22,50 @@ class wmModule(Module):
         self.state.title = None
         self.state.monitors = dict()
         self.state.workspaces = dict()
+        self.state.windows = dict()
+
+    def update_monitors(self, monitors):
+        """
+        Replace the monitors, emits "wm", "monitor" events for each changed
+        monitor and "wm", "monitors" if any changed
+        """
+        self._update("monitors", "monitor", monitors)
+
+    def update_workspaces(self, workspaces):
+        """
+        Replace the workspaces, emits "wm", "workspace" events for each
+        changed workspace and "wm", "workspaces" if any changed
+        """
+        self._update("workspaces", "workspace", workspaces)
+
+    def update_windows(self, windows):
+        """
+        Replace the windows, emits "wm", "window" events for each changed
+        window and "wm", "windows" if any changed
+        """
+        self._update("windows", "window", windows)
+
+    # private API
+
+    def _link(self, collection, added, removed, changed):
+        """
+        called after the state was updated and before events are emitted,
+        window manager modules can link monitors, workspaces and windows here
+
+        gets the name of the updated collection and its diff
+        """
+        pass
+
+    def _update(self, collection, event, new):
+        added, removed, changed = diff(getattr(self.state, collection), new)
+        setattr(self.state, collection, new)
+        self._link(collection, added, removed, changed)
+
+        for key in removed:
+            self.emit("wm", event, key, "removed")
+        for key in added:
+            self.emit("wm", event, key, "added")
+        for key, fields in changed.items():
+            self.emit("wm", event, key, "changed", fields)
+        if len(added) + len(removed) + len(changed) != 0:
+            self.emit("wm", collection)
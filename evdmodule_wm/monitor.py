@@ -1,7 +1,11 @@
+from .diff import field_diff
+
 class Monitor(object):
     """
     Represents a monitor
 
+    Monitors compare equal if all attributes except workspaces are equal
+
     Attributes:
     - rect: the screen rectangle the monitor occupies
     - name: the monitors name or id
@@ -9,6 +13,9 @@ class Monitor(object):
     - primary: whether this is the primary monitor
     - workspaces: a list of workspaces associated with this monitor
     """
+    __slots__ = ("rect", "name", "active", "primary", "workspaces")
+    fields = ("rect", "name", "active", "primary")
+
     def __init__(self, rect, name):
         self.rect = rect
         self.name = name
@@ -16,6 +23,29 @@ class Monitor(object):
         self.primary = False
         self.workspaces = []
 
+    def copy(self):
+        """
+        Returns a shallow copy of this monitor
+        """
+        monitor = Monitor(self.rect, self.name)
+        monitor.active = self.active
+        monitor.primary = self.primary
+        monitor.workspaces = list(self.workspaces)
+        return monitor
+
+    def diff(self, other):
+        """
+        Returns the names of the attributes that differ from other
+        """
+        return field_diff(self, other)
+
+    def __eq__(self, other):
+        if not isinstance(other, Monitor):
+            return NotImplemented
+        return len(self.diff(other)) == 0
+
+    __hash__ = None
+
     def __str__(self):
         return ("<Monitor {} rect={}, active={}, primary={}>"
             .format(self.name, self.rect, self.active, self.primary)
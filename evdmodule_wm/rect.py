@@ -8,12 +8,24 @@ class Rect(object):
     - width: rectangle extent in x direction, rightwards from position
     - height: rectangle extent in y direction, downwards from position
     """
+    __slots__ = ("x", "y", "width", "height")
+
     def __init__(self, x, y, w, h):
         self.x = x
         self.y = y
         self.width = w
         self.height = h
 
+    def __eq__(self, other):
+        if not isinstance(other, Rect):
+            return NotImplemented
+        return (
+            self.x == other.x and self.y == other.y and
+            self.width == other.width and self.height == other.height
+        )
+
+    __hash__ = None
+
     def __str__(self):
         return ("{}x{}+{}+{}"
             .format(self.width, self.height, self.x, self.y)
@@ -1,14 +1,58 @@
+from .diff import field_diff
+
 class Window(object):
     """
     Represents a window
 
+    Windows compare equal if all attributes except workspace are equal
+
     Attributes:
-    - wid: the Xorg window id
+    - wid: the Xorg window id (None for windows without one)
+    - title: the window title
+    - focused: whether this window is focused
+    - urgent: whether this window has an urgency hint
+    - floating: whether this window is floating
+    - workspace: the workspace this window is on
     """
+    __slots__ = ("wid", "title", "focused", "urgent", "floating", "workspace")
+    fields = ("wid", "title", "focused", "urgent", "floating")
+
     def __init__(self, wid):
         self.wid = wid
+        self.title = None
+        self.focused = False
+        self.urgent = False
+        self.floating = False
+        self.workspace = None
+
+    def copy(self):
+        """
+        Returns a shallow copy of this window
+        """
+        window = Window(self.wid)
+        window.title = self.title
+        window.focused = self.focused
+        window.urgent = self.urgent
+        window.floating = self.floating
+        window.workspace = self.workspace
+        return window
+
+    def diff(self, other):
+        """
+        Returns the names of the attributes that differ from other
+        """
+        return field_diff(self, other)
+
+    def __eq__(self, other):
+        if not isinstance(other, Window):
+            return NotImplemented
+        return len(self.diff(other)) == 0
+
+    __hash__ = None
 
     def __str__(self):
+        if self.wid == None:
+            return "<Window {!r}>".format(self.title)
         return "<Window 0x{:08x}>".format(self.wid)
     def __repr__(self):
         return str(self)
@@ -1,7 +1,12 @@
+from .diff import field_diff
+
 class Workspace(object):
     """
     Represents a workspace
 
+    Workspaces compare equal if all attributes except monitor and windows are
+    equal
+
     Attributes:
     - rect: the rectangle the workspace occupies
     - name: the name of the workspace
@@ -12,6 +17,9 @@ class Workspace(object):
     - monitor: the monitor this workspace is currently on or associated with
     - windows: the windows in this workspace
     """
+    __slots__ = ("rect", "name", "num", "visible", "focused", "urgent", "monitor", "windows")
+    fields = ("rect", "name", "num", "visible", "focused", "urgent")
+
     def __init__(self, rect, name, num):
         self.rect = rect
         self.name = name
@@ -22,6 +30,31 @@ class Workspace(object):
         self.monitor = None
         self.windows = []
 
+    def copy(self):
+        """
+        Returns a shallow copy of this workspace
+        """
+        ws = Workspace(self.rect, self.name, self.num)
+        ws.visible = self.visible
+        ws.focused = self.focused
+        ws.urgent = self.urgent
+        ws.monitor = self.monitor
+        ws.windows = list(self.windows)
+        return ws
+
+    def diff(self, other):
+        """
+        Returns the names of the attributes that differ from other
+        """
+        return field_diff(self, other)
+
+    def __eq__(self, other):
+        if not isinstance(other, Workspace):
+            return NotImplemented
+        return len(self.diff(other)) == 0
+
+    __hash__ = None
+
     def __str__(self):
         return ("<Workspace {} visible={}, focused={}, urgent={}>"
             .format(